@@ -0,0 +1,223 @@
+import logging.config
+import os
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+import redis
+
+from lib import metrics
+from lib.db_helper import UPSERT_CHUNK_SIZE
+from lib.downloads import DownloadResult, file_sha256, link_into_place
+from lib.image_derivatives import remove_unused_derivatives
+from lib.models import Session, ScheduleSlot, Event, Asset
+from lib.utils import connect_to_redis
+from settings import settings
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+# Downloaded images and templates are stored once each in blobs_folder, named by the sha256 of their content. The
+# files that everything else reads, named by uuid, are hard links to those blobs, so the same image uploaded under two
+# uuids only takes up space once. The Asset table maps each uuid to its hash.
+#
+# When the blobs and image derivatives add up to more than the asset_quota setting, the least recently used assets
+# are deleted, never including anything a schedule slot or an unfinished event needs.
+
+# Asset kinds
+IMAGE = "image"
+TEMPLATE = "template"
+
+STATS_KEY = "asset-store-stats"  # Redis hash of counters, shared by every process that syncs
+
+STORE_HIT_RATE = metrics.gauge("kenban_asset_store_hit_rate", "How often a wanted asset was already stored")
+
+
+class EvictionResult(NamedTuple):
+    evicted: int
+    bytes_reclaimed: int
+    bytes_used: int
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(settings["blobs_folder"], sha256)
+
+
+def asset_paths(kind: str, uuid: str) -> List[str]:
+    """ Where an asset's content is linked to, the blob-backed original first """
+    if kind == IMAGE:
+        return [os.path.join(settings["original_images_folder"], uuid), os.path.join(settings["images_folder"], uuid)]
+    return [os.path.join(settings["templates_folder"], uuid)]
+
+
+def record_stats(**counts):
+    """ Add to the counters in STATS_KEY, e.g. record_stats(hits=3, misses=1) """
+    counts = {name: count for name, count in counts.items() if count}
+    if not counts:
+        return
+    try:
+        with connect_to_redis().pipeline(transaction=False) as pipe:
+            for name, count in counts.items():
+                pipe.hincrby(STATS_KEY, name, count)
+            pipe.execute()
+    except redis.exceptions.ConnectionError:
+        logging.debug("Could not record asset store stats")
+
+
+def store_stats() -> Dict[str, float]:
+    """ The counters recorded so far, plus the hit rate: how often a wanted asset was already stored """
+    stats = {k.decode('utf-8'): int(v) for k, v in connect_to_redis().hgetall(STATS_KEY).items()}
+    wanted = stats.get("hits", 0) + stats.get("misses", 0)
+    stats["hit_rate"] = stats.get("hits", 0) / wanted if wanted else 0.0
+    return stats
+
+
+def export_hit_rate():
+    """ Copy the hit rate into lib.metrics. Read from STATS_KEY, so it covers every process that syncs """
+    try:
+        STORE_HIT_RATE.set(store_stats()["hit_rate"])
+    except redis.exceptions.ConnectionError:
+        logging.debug("Could not read asset store stats")
+
+
+def ingest(kind: str, uuid: str, result: DownloadResult):
+    """ Move a freshly downloaded file into the blob store, leaving a link where it was downloaded to. If the same
+    content is already stored, the new copy is dropped in favour of the existing blob """
+    if not result.ok or result.not_modified:
+        return
+    os.makedirs(settings["blobs_folder"], exist_ok=True)
+    blob = blob_path(result.sha256)
+    if os.path.exists(blob):
+        if not os.path.samefile(blob, result.path):
+            logging.debug(f"{kind} {uuid} is a duplicate of blob {result.sha256}")
+            link_into_place(blob, result.path)
+            record_stats(deduplicated_bytes=result.size)
+    else:
+        link_into_place(result.path, blob)
+
+
+def touch(kind: str, uuids: List[str], session=None):
+    """ Mark assets as recently used """
+    if session is None:
+        with Session() as session:
+            touch(kind, uuids, session)
+            session.commit()
+        return
+    uuids = list(uuids)
+    now = datetime.now()
+    for i in range(0, len(uuids), UPSERT_CHUNK_SIZE):
+        session.query(Asset).filter(Asset.kind == kind, Asset.uuid.in_(uuids[i:i + UPSERT_CHUNK_SIZE])) \
+            .update({Asset.last_used: now}, synchronize_session=False)
+
+
+def referenced_assets(session) -> Set[Tuple[str, str]]:
+    """ (kind, uuid) of every asset the schedule needs. Slots repeat weekly, so every slot is current or upcoming """
+    referenced = set()
+    for template_uuid, image_uuid in session.query(ScheduleSlot.template_uuid, ScheduleSlot.foreground_image_uuid):
+        referenced.update({(TEMPLATE, template_uuid), (IMAGE, image_uuid)})
+    for (image_uuid,) in session.query(Event.foreground_image_uuid).filter(Event.event_end > datetime.now()):
+        referenced.add((IMAGE, image_uuid))
+    # Templates can refer to images directly, so keep any image whose uuid appears in a template that's in use
+    image_uuids = [uuid for (uuid,) in session.query(Asset.uuid).filter_by(kind=IMAGE)]
+    for kind, uuid in list(referenced):
+        if kind != TEMPLATE or not uuid:
+            continue
+        try:
+            with open(os.path.join(settings["templates_folder"], uuid)) as f:
+                source = f.read()
+        except OSError:
+            continue
+        referenced.update((IMAGE, image_uuid) for image_uuid in image_uuids if image_uuid in source)
+    return {(kind, uuid) for kind, uuid in referenced if uuid}
+
+
+def adopt_unstored_files(session):
+    """ Move files downloaded before the blob store existed into it, merging duplicates """
+    for asset in session.query(Asset).filter(Asset.evicted.isnot(True)):
+        fp = asset_paths(asset.kind, asset.uuid)[0]
+        blob = blob_path(asset.sha256)
+        try:
+            if os.path.exists(blob) and os.path.samefile(blob, fp):
+                continue
+            if file_sha256(fp) != asset.sha256:
+                logging.warning(f"{fp} doesn't match the asset manifest, leaving it out of the store")
+                continue
+            ingest(asset.kind, asset.uuid, DownloadResult(url="", path=fp, size=asset.size, seconds=0,
+                                                          sha256=asset.sha256))
+        except OSError:
+            continue  # Not downloaded
+
+
+def folder_usage(folder: str) -> int:
+    if not os.path.isdir(folder):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+def store_usage() -> int:
+    return folder_usage(settings["blobs_folder"]) + folder_usage(settings["image_derivatives_folder"])
+
+
+def remove_unlinked_blobs() -> int:
+    """ Delete blobs no uuid links to any more, because the asset was replaced or evicted. Returns bytes freed """
+    freed = 0
+    folder = settings["blobs_folder"]
+    if not os.path.isdir(folder):
+        return 0
+    for entry in os.scandir(folder):
+        stat = entry.stat()
+        if entry.is_file() and stat.st_nlink == 1:
+            os.remove(entry.path)
+            freed += stat.st_size
+    return freed
+
+
+def evict(asset: Asset) -> int:
+    """ Delete an asset's files. Returns roughly how many bytes that frees, once unlinked blobs and derivatives are
+    removed """
+    freed = 0
+    for fp in asset_paths(asset.kind, asset.uuid):
+        try:
+            stat = os.stat(fp)
+            os.remove(fp)
+        except OSError:
+            continue
+        # Only this file and its blob or derivative were left, so both go
+        if stat.st_nlink <= 2:
+            freed += stat.st_size
+    asset.evicted = True
+    logging.info(f"Evicted {asset.kind} {asset.uuid}, last used {asset.last_used}")
+    return freed
+
+
+def enforce_quota(quota: int = None) -> EvictionResult:
+    """ Delete least recently used assets until the store is under quota bytes. Assets the schedule needs are never
+    evicted, so the store can stay over quota if they alone take up too much """
+    quota = settings["asset_quota"] if quota is None else quota
+    evicted = 0
+    with Session() as session:
+        adopt_unstored_files(session)
+        # Left behind when assets were replaced with new versions
+        reclaimed = remove_unlinked_blobs() + remove_unused_derivatives()
+        used = store_usage()
+        protected = referenced_assets(session)
+        for kind in (IMAGE, TEMPLATE):
+            touch(kind, [uuid for k, uuid in protected if k == kind], session)
+        if used > quota:
+            used_before = used
+            for asset in session.query(Asset).filter(Asset.evicted.isnot(True)).order_by(Asset.last_used).all():
+                if used <= quota:
+                    break
+                if (asset.kind, asset.uuid) in protected:
+                    continue
+                used -= evict(asset)
+                evicted += 1
+            remove_unlinked_blobs()
+            remove_unused_derivatives()
+            used = store_usage()
+            reclaimed += used_before - used
+        session.commit()
+    if used > quota:
+        logging.warning(f"Asset store is over quota with only scheduled assets left: {used} of {quota} bytes")
+    record_stats(evictions=evicted, bytes_reclaimed=reclaimed)
+    export_hit_rate()
+    logging.info(f"Asset store: {used / 1e6:.1f} MB used, evicted {evicted} assets, reclaimed {reclaimed / 1e6:.1f} MB")
+    return EvictionResult(evicted=evicted, bytes_reclaimed=reclaimed, bytes_used=used)
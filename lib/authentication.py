@@ -1,32 +1,117 @@
-import datetime
 import json
 import logging.config
 import uuid
 from json import JSONDecodeError
 from os import getenv
-from time import mktime
-from time import sleep
+from time import sleep, time
 
 
 import jwt
-import requests
-from requests.exceptions import ConnectionError
+import redis
+from redis.exceptions import LockError
+from requests.exceptions import ConnectionError, Timeout
 
-from lib.utils import kenban_server_request
+from lib.http_client import http_request
+from lib.utils import kenban_server_request, connect_to_redis
 from settings import settings
 
 PORT = int(getenv('PORT', 8080))
 LISTEN = getenv('LISTEN', '127.0.0.1')
 
+# The current access token is shared between processes through redis, so only one of them has to refresh it
+ACCESS_TOKEN_KEY = "access-token"
+REFRESH_LOCK = "access-token-refresh-lock"
+REFRESH_LOCK_TIMEOUT = 30  # secs
+REFRESH_MARGIN = 60  # secs. Refresh this long before the token expires, so requests never go out with a stale one
+
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
 
+# This process's copy of the access token, and its decoded expiry time
+_cached_access_token = None
+_cached_expiry = 0
+
+
+def token_expiry(access_token) -> float:
+    """ The expiry timestamp of a JWT, or 0 if it can't be read """
+    try:
+        decoded = jwt.decode(access_token, algorithms=["HS256"], options={"verify_signature": False})
+        return float(decoded["exp"])
+    except (jwt.exceptions.PyJWTError, KeyError, TypeError, ValueError):
+        return 0
+
+
+def cache_access_token(access_token, share=True):
+    """ Remember the token in this process, and optionally publish it for the other processes """
+    global _cached_access_token, _cached_expiry
+    _cached_access_token = access_token
+    _cached_expiry = token_expiry(access_token)
+    if share and _cached_expiry > time():
+        try:
+            connect_to_redis().set(ACCESS_TOKEN_KEY, access_token, ex=max(1, int(_cached_expiry - time())))
+        except redis.exceptions.ConnectionError:
+            logging.warning("Could not share access token through redis")
+
+
+def fresh_enough(expiry) -> bool:
+    return time() < expiry - REFRESH_MARGIN
+
+
+def shared_access_token():
+    """ The token most recently refreshed by any process, without re-reading kenban.conf """
+    try:
+        access_token = connect_to_redis().get(ACCESS_TOKEN_KEY)
+    except redis.exceptions.ConnectionError:
+        return None
+    return access_token.decode('utf-8') if access_token else None
+
+
+def release_refresh_lock(lock):
+    """ Release the lock separately from the refresh, so a refresh that worked is never repeated because of it """
+    try:
+        lock.release()
+    except LockError:
+        logging.warning(f"Access token refresh took longer than {REFRESH_LOCK_TIMEOUT}s, so its lock had expired")
+    except redis.exceptions.ConnectionError:
+        logging.warning("Could not release access token refresh lock")
+
 
 def get_access_token():
+    if _cached_access_token and fresh_enough(_cached_expiry):
+        return _cached_access_token
+
+    # Another process may have refreshed it already
+    access_token = shared_access_token()
+    if fresh_enough(token_expiry(access_token)):
+        cache_access_token(access_token, share=False)
+        return access_token
+    # After a reboot, the copy saved in settings may still be good
     access_token = settings["access_token"]
-    decoded_access_token = jwt.decode(access_token, algorithms=["HS256"], options={"verify_signature": False})
-    current_timestamp = mktime(datetime.datetime.now().timetuple())
-    if current_timestamp > decoded_access_token["exp"]:
+    if fresh_enough(token_expiry(access_token)):
+        cache_access_token(access_token)
+        return access_token
+
+    # Only one process refreshes at a time. The others wait, and then use the token it got
+    lock = connect_to_redis().lock(REFRESH_LOCK, timeout=REFRESH_LOCK_TIMEOUT, blocking_timeout=REFRESH_LOCK_TIMEOUT)
+    try:
+        locked = lock.acquire()
+    except redis.exceptions.ConnectionError:
+        locked = False
+    try:
+        # The process that held the lock may have just refreshed it
+        access_token = shared_access_token()
+        if fresh_enough(token_expiry(access_token)):
+            cache_access_token(access_token, share=False)
+            return access_token
+        if not locked:
+            logging.warning("Could not lock access token refresh, refreshing anyway")
         access_token = refresh_access_token()
+    finally:
+        if locked:
+            release_refresh_lock(lock)
+
+    if access_token is None and _cached_access_token and time() < _cached_expiry:
+        # Refresh failed, but the old token hasn't quite expired yet
+        return _cached_access_token
     return access_token
 
 
@@ -49,10 +134,10 @@ def register_new_client():
         settings.save()
     try:
         data = json.dumps({u"uuid": device_uuid})
-        response = requests.post(url=url,
-                                 data=data,
-                                 headers={'content-type': 'application/json'})
-    except ConnectionError:
+        response = http_request("POST", url=url,
+                                data=data,
+                                headers={'content-type': 'application/json'})
+    except (ConnectionError, Timeout):
         logging.exception("Could not connect to authorisation server at {0}".format(url))
         return None, None
     except ValueError:
@@ -77,8 +162,8 @@ def poll_for_authentication(device_code):
         url = settings['server_address'] + settings['device_auth_uri']
         data = json.dumps({"device_code": device_code})
         try:
-            response = requests.post(url=url, data=data)
-        except ConnectionError:
+            response = http_request("POST", url=url, data=data)
+        except (ConnectionError, Timeout):
             logging.warning("Could not connect to authorisation server at {0}".format(url))
             sleep(5)
             continue
@@ -98,6 +183,7 @@ def poll_for_authentication(device_code):
             settings["access_token"] = response_body["access_token"]
             settings["screen_name"] = response_body["screen_name"]
             settings.save()
+            cache_access_token(response_body["access_token"])
             logging.info("Access tokens received from server")
             return True
         else:
@@ -125,5 +211,6 @@ def refresh_access_token():
         logging.error("Failed to get access token from server")
         return None
     settings["access_token"] = response["access_token"]
-    settings.save()
+    settings.save()  # So the token survives a reboot
+    cache_access_token(response["access_token"])
     return response["access_token"]
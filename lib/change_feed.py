@@ -0,0 +1,91 @@
+import logging.config
+from typing import List, NamedTuple, Optional, Tuple
+
+import redis
+
+from lib.utils import connect_to_redis
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+# Every committed change to a schedule slot or event is appended to this redis stream, so the scheduler can apply
+# it on its own instead of reloading the whole database. Each record carries a sequence number, so a reader can
+# tell if records were trimmed away before it read them, and fall back to a full reload.
+CHANGE_STREAM = "schedule-changes"
+CHANGE_SEQ = "schedule-change-seq"
+STREAM_MAXLEN = 1000
+
+SCHEDULE_SLOT = "schedule_slot"
+EVENT = "event"
+UPSERT = "upsert"
+DELETE = "delete"
+RELOAD = "reload"  # Too many changes to be worth applying one by one
+
+# Above this many changes in one commit (e.g. a full sync), publish a single RELOAD record instead
+MAX_CHANGES_PER_PUBLISH = 100
+
+# Incrementing the sequence number and appending the record must be atomic, or concurrent writers could interleave
+PUBLISH_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1], '*', 'seq', seq, 'entity', ARGV[2], 'uuid', ARGV[3], 'op', ARGV[4])
+return seq
+"""
+
+
+class Change(NamedTuple):
+    id: str  # Redis stream id
+    seq: int
+    entity: str
+    uuid: str
+    op: str
+
+
+def publish_changes(changes: List[Tuple[str, str, str]]):
+    """ Append (entity, uuid, op) records to the change feed """
+    if not changes:
+        return
+    if len(changes) > MAX_CHANGES_PER_PUBLISH:
+        changes = [("all", "", RELOAD)]
+    r = connect_to_redis()
+    script = r.register_script(PUBLISH_SCRIPT)
+    try:
+        with r.pipeline(transaction=False) as pipe:
+            for entity, uuid, op in changes:
+                script(keys=[CHANGE_SEQ, CHANGE_STREAM], args=[STREAM_MAXLEN, entity, uuid, op], client=pipe)
+            pipe.execute()
+    except redis.exceptions.ConnectionError:
+        logging.exception("Failed to publish schedule changes")
+
+
+def latest_position() -> Tuple[str, int]:
+    """ The stream id and sequence number of the most recent change. Read this before loading from the database, so
+    that changes committed during the load are applied afterwards rather than missed """
+    r = connect_to_redis()
+    entries = r.xrevrange(CHANGE_STREAM, count=1)
+    if entries:
+        entry_id, fields = entries[0]
+        return entry_id.decode('utf-8'), int(fields[b"seq"])
+    return "0-0", int(r.get(CHANGE_SEQ) or 0)
+
+
+def changes_since(position: Tuple[str, int]) -> Optional[List[Change]]:
+    """ Changes published after position, in order. Returns None if any are missing """
+    last_id, last_seq = position
+    r = connect_to_redis()
+    response = r.xread({CHANGE_STREAM: last_id})
+    entries = response[0][1] if response else []
+    changes = []
+    for entry_id, fields in entries:
+        change = Change(id=entry_id.decode('utf-8'),
+                        seq=int(fields[b"seq"]),
+                        entity=fields[b"entity"].decode('utf-8'),
+                        uuid=fields[b"uuid"].decode('utf-8'),
+                        op=fields[b"op"].decode('utf-8'))
+        if change.seq != last_seq + len(changes) + 1:
+            logging.warning(f"Gap in schedule change feed: expected {last_seq + len(changes) + 1}, got {change.seq}")
+            return None
+        changes.append(change)
+    if int(r.get(CHANGE_SEQ) or 0) < last_seq + len(changes):
+        # Redis lost its data, so the sequence has gone backwards
+        logging.warning("Schedule change feed was reset")
+        return None
+    return changes
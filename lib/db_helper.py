@@ -1,12 +1,64 @@
 import logging.config
+from datetime import datetime
+from typing import Dict, List, Tuple
 
 from dateutil.parser import parse
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-from lib.models import Session, ScheduleSlot, Event
-from lib.utils import time_parser
+from lib import change_feed
+from lib.downloads import DownloadResult
+from lib.models import Session, ScheduleSlot, Event, Asset
+from lib.utils import time_parser, wake_display
 
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
 
+# Rows per INSERT statement. Keeps the number of bound parameters under SQLite's limit (999 on older versions)
+UPSERT_CHUNK_SIZE = 100
+
+
+def record_change(session: Session, entity: str, uuid: str, op: str = change_feed.UPSERT):
+    """ Queue a change feed record, to be published once the session commits """
+    session.info.setdefault("schedule_changes", []).append((entity, uuid, op))
+
+
+@sqlalchemy_event.listens_for(Session, "after_commit")
+def publish_recorded_changes(session):
+    changes = session.info.pop("schedule_changes", None)
+    if changes:
+        change_feed.publish_changes(changes)
+        wake_display("schedule changed")
+
+
+@sqlalchemy_event.listens_for(Session, "after_rollback")
+def discard_recorded_changes(session):
+    session.info.pop("schedule_changes", None)
+
+
+def schedule_slot_row(slot) -> dict:
+    """ Convert a schedule slot from the server into column values """
+    return {
+        "uuid": slot["uuid"],
+        "template_uuid": slot["template_uuid"],
+        "foreground_image_uuid": slot["foreground_image_uuid"],
+        "display_text": slot["display_text"],
+        "time_format": slot["time_format"],
+        "start_time": time_parser(slot["start_time"]),
+        "weekday": slot["weekday"],
+    }
+
+
+def event_row(event) -> dict:
+    """ Convert an event from the server into column values """
+    return {
+        "uuid": event["uuid"],
+        "foreground_image_uuid": event["foreground_image_uuid"],
+        "display_text": event["display_text"],
+        "event_start": parse(event["event_start"]),
+        "event_end": parse(event["event_end"]),
+        "override": event.get("override"),
+    }
+
 
 def create_or_update_schedule_slot(session: Session, slot: ScheduleSlot):
     logging.debug("Saving schedule slot")
@@ -14,13 +66,9 @@ def create_or_update_schedule_slot(session: Session, slot: ScheduleSlot):
     if not db_slot:
         db_slot = ScheduleSlot()
         session.add(db_slot)
-    db_slot.uuid = slot["uuid"]
-    db_slot.template_uuid = slot["template_uuid"]
-    db_slot.foreground_image_uuid = slot["foreground_image_uuid"]
-    db_slot.display_text = slot["display_text"]
-    db_slot.time_format = slot["time_format"]
-    db_slot.start_time = time_parser(slot["start_time"])
-    db_slot.weekday = slot["weekday"]
+    for column, value in schedule_slot_row(slot).items():
+        setattr(db_slot, column, value)
+    record_change(session, change_feed.SCHEDULE_SLOT, slot["uuid"])
 
 
 def create_or_update_event(session: Session, event):
@@ -29,9 +77,59 @@ def create_or_update_event(session: Session, event):
     if not db_event:
         db_event = Event()
         session.add(db_event)
-    db_event.uuid = event["uuid"]
-    db_event.foreground_image_uuid = event["foreground_image_uuid"]
-    db_event.display_text = event["display_text"]
-    db_event.event_start = parse(event["event_start"])
-    db_event.event_end = parse(event["event_end"])
-    db_event.override = event.get("override")
+    for column, value in event_row(event).items():
+        setattr(db_event, column, value)
+    record_change(session, change_feed.EVENT, event["uuid"])
+
+
+def sync_all_schedule_slots(session: Session, slots):
+    """ Make the schedule_slot table match the full list of slots from the server. Doesn't commit """
+    bulk_upsert(session, ScheduleSlot, [schedule_slot_row(s) for s in slots], change_feed.SCHEDULE_SLOT)
+
+
+def sync_all_events(session: Session, events):
+    """ Make the event table match the full list of events from the server. Doesn't commit """
+    bulk_upsert(session, Event, [event_row(e) for e in events], change_feed.EVENT)
+
+
+def bulk_upsert(session: Session, model, rows, entity: str):
+    """ Insert or update rows with one multi-row INSERT ... ON CONFLICT(uuid) DO UPDATE per chunk, then delete any
+    rows that aren't in the list """
+    rows = list({row["uuid"]: row for row in rows}.values())  # SQLite can't update the same row twice in one statement
+    logging.debug(f"Bulk saving {len(rows)} rows to {model.__tablename__}")
+    for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        chunk = rows[i:i + UPSERT_CHUNK_SIZE]
+        statement = sqlite_insert(model).values(chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=[model.uuid],
+            set_={column: statement.excluded[column] for column in chunk[0] if column != "uuid"})
+        session.execute(statement)
+
+    new_uuids = {row["uuid"] for row in rows}
+    stale_uuids = [uuid for (uuid,) in session.query(model.uuid) if uuid not in new_uuids]
+    for i in range(0, len(stale_uuids), UPSERT_CHUNK_SIZE):
+        chunk = stale_uuids[i:i + UPSERT_CHUNK_SIZE]
+        session.query(model).filter(model.uuid.in_(chunk)).delete(synchronize_session=False)
+    if stale_uuids:
+        logging.info(f"Deleted {len(stale_uuids)} rows from {model.__tablename__} that are no longer on the server")
+
+    for uuid in new_uuids:
+        record_change(session, entity, uuid)
+    for uuid in stale_uuids:
+        record_change(session, entity, uuid, change_feed.DELETE)
+
+
+def get_asset_manifest(kind: str) -> Dict[str, Asset]:
+    with Session() as session:
+        return {asset.uuid: asset for asset in session.query(Asset).filter_by(kind=kind)}
+
+
+def record_downloaded_assets(kind: str, downloads: List[Tuple[str, DownloadResult]]):
+    """ Save the hash, size and cache validators of freshly downloaded (uuid, result) files to the manifest """
+    with Session() as session:
+        for uuid, result in downloads:
+            if not result.ok or result.not_modified:
+                continue
+            session.merge(Asset(kind=kind, uuid=uuid, sha256=result.sha256, size=result.size, etag=result.etag,
+                                last_modified=result.last_modified, last_used=datetime.now(), evicted=False))
+        session.commit()
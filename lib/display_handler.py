@@ -1,78 +1,284 @@
 import logging.config
+import os
+import tempfile
+import threading
 from datetime import datetime, timedelta
-from time import sleep
+from time import perf_counter, sleep, time
+from typing import NamedTuple, Optional
 
 import humanize
 from PyQt5.QtCore import QThread, pyqtSignal
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
 
+from lib import metrics
 from lib.authentication import register_new_client, poll_for_authentication, get_auth_header
 from lib.models import ScheduleSlot
-from lib.scheduler import Scheduler
-from lib.utils import connect_to_redis, get_db_mtime, wait_for_wifi_manager, kenban_server_request, \
-    wait_for_startup_sync, wait_for_internet_ping, force_ntp_update
+from lib.render_cache import RenderCache
+from lib.scheduler import Scheduler, TRANSITION_MARGIN
+from lib.state_bus import StateSubscription, wait_for_state, wait_for_startup_sync, wait_for_wifi_manager, \
+    INTERNET_CONNECTED, WIFI_CONNECT_STATUS, WIFI_MANAGER_CONNECTING
+from lib.utils import connect_to_redis, kenban_server_request, wait_for_internet_ping, force_ntp_update, \
+    start_redis_listener, DISPLAY_WAKEUP_CHANNEL, TEMPLATE_UPDATED_CHANNEL, wait_for_redis
 from settings import settings
 
 EMPTY_PL_DELAY = 5  # secs
-SCREEN_TICK_DELAY = 0.2  # secs
+REBOOTED_BANNER_TIME = 15  # secs
+MAX_TICK_DELAY = 300  # secs. Safety net in case a wakeup is missed
+HOTSPOT_SAFETY_POLL = 5  # secs. The hotspot page is redrawn on every wifi-connect status change, or at least this often
 
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
 logger = logging.getLogger("viewer")
 
+DISPLAY_LOOP_SECONDS = metrics.histogram("kenban_display_loop_seconds",
+                                         "Time spent on each pass of the display loop, not counting waits")
+DISPLAY_WAKEUPS = metrics.counter("kenban_display_wakeups_total", "Times the display loop was woken early")
+RENDER_SECONDS = metrics.histogram("kenban_render_seconds", "Time taken to render the schedule, including cache hits")
+
+# Compiled templates are cached on disk, so they don't have to be recompiled from source every time the viewer starts.
+# Templates aren't checked for changes on every get_template(): default templates only change with a software update,
+# and sync announces replaced user templates on TEMPLATE_UPDATED_CHANNEL
+os.makedirs(settings["jinja_cache_folder"], exist_ok=True)
+bytecode_cache = FileSystemBytecodeCache(settings["jinja_cache_folder"])
+
 default_templates_env = Environment(
     loader=FileSystemLoader(settings["default_templates_folder"]),
-    autoescape=select_autoescape()
+    autoescape=select_autoescape(),
+    bytecode_cache=bytecode_cache,
+    auto_reload=False
 )
 
 user_templates_env = Environment(
     loader=FileSystemLoader(settings["templates_folder"]),
-    autoescape=select_autoescape()
+    autoescape=select_autoescape(),
+    bytecode_cache=bytecode_cache,
+    auto_reload=False
 )
 
 
+class DeviceStatus(NamedTuple):
+    internet_connected: bool
+    last_connected: Optional[float]
+    websocket_connected: bool
+    websocket_dc_timestamp: Optional[float]
+    rebooted: bool
+    refresh_browser: bool
+
+
+def get_device_status(r) -> DeviceStatus:
+    """ Read all of the status flags the display loop needs in a single round trip """
+    with r.pipeline(transaction=False) as pipe:
+        pipe.getbit("internet-connected", 0)
+        pipe.get("last-connected")
+        pipe.getbit("websocket-connected", 0)
+        pipe.get("websocket-dc-timestamp")
+        pipe.exists("rebooted")
+        pipe.exists("refresh-browser")
+        internet, last_connected, websocket, websocket_dc, rebooted, refresh_browser = pipe.execute()
+    return DeviceStatus(internet_connected=bool(internet),
+                        last_connected=float(last_connected) if last_connected else None,
+                        websocket_connected=bool(websocket),
+                        websocket_dc_timestamp=float(websocket_dc) if websocket_dc else None,
+                        rebooted=bool(rebooted),
+                        refresh_browser=bool(refresh_browser))
+
+
+def banner_timestamp(status: DeviceStatus) -> Optional[float]:
+    """ The timestamp the banner is currently describing as "N minutes ago", if any """
+    if not status.internet_connected:
+        return status.last_connected
+    elif not status.websocket_connected:
+        return status.websocket_dc_timestamp
+    return None
+
+
+def save_display_snapshot(html):
+    """ Keep a copy of the page on screen, to show straight away on the next boot if the schedule can't be rendered """
+    folder = os.path.dirname(settings["display_snapshot"])
+    try:
+        with tempfile.NamedTemporaryFile("w", dir=folder, prefix=".display_snapshot.", delete=False) as f:
+            f.write(html)
+        os.replace(f.name, settings["display_snapshot"])
+    except OSError:
+        logger.exception("Could not save display snapshot")
+
+
+def load_display_snapshot() -> Optional[str]:
+    try:
+        with open(settings["display_snapshot"]) as f:
+            return f.read() or None
+    except OSError:
+        return None
+
+
+def banner_wording_changes_at(status: DeviceStatus) -> Optional[datetime]:
+    """ When the humanized "N minutes/hours/days ago" text in the banner will next change """
+    timestamp = banner_timestamp(status)
+    if timestamp is None:
+        return None
+    age = time() - timestamp
+    unit = 60 if age < 3600 else 3600 if age < 86400 else 86400
+    return datetime.fromtimestamp(timestamp + (age // unit + 1) * unit)
+
+
 # noinspection PyMethodMayBeStatic
 class DisplayHandler(QThread):
     default_template = pyqtSignal(str)
-    user_template = pyqtSignal(str)
+    user_template = pyqtSignal(str, str, bool)  # html, page key, whether the page must be reloaded
+    prerender_template = pyqtSignal(str, str)  # html, page key of the next slot, to load off-screen
 
     def __init__(self):
         self.scheduler = Scheduler()
-        self.current_banner_message = ""
+        self.render_cache = RenderCache(user_templates_env, settings["templates_folder"])
+        self.current_banner_message = None  # None so the first banner is always published
+        self.prerendered = None  # (page key, html) last sent to the viewer's off-screen page
+        self.prerendered_start = None  # The next_slot_start it was rendered for
+        self.showing_snapshot = False  # The last page shown before shutdown is up, until the schedule can be rendered
+        self.wakeup = threading.Event()
+        # Set by the background network checks, for the display loop to act on
+        self.showing_hotspot = False
+        self.clock_changed = False
         super(DisplayHandler, self).__init__()
 
+    def wake(self, reason=None):
+        logger.debug(f"Display loop woken: {reason}")
+        DISPLAY_WAKEUPS.inc()
+        self.wakeup.set()
+
+    def wait_until(self, deadline: datetime):
+        """ Block until deadline, or until something publishes a wakeup """
+        timeout = min((deadline - datetime.now()).total_seconds(), MAX_TICK_DELAY)
+        if timeout > 0:
+            self.wakeup.wait(timeout)
+
     def show_default_template(self, html):
+        self.showing_snapshot = False
         # noinspection PyUnresolvedReferences
         self.default_template.emit(html)
 
-    def show_user_template(self, html):
+    def show_user_template(self, html, page_key="", reload=False):
+        """ The viewer patches the page in place if page_key matches the page it's showing, so it must change whenever
+        the template itself does """
+        if (page_key, html) == self.prerendered and not reload:
+            self.prerendered = None  # The viewer swaps the off-screen page in, leaving nothing loaded there
         # noinspection PyUnresolvedReferences
-        self.user_template.emit(html)
+        self.user_template.emit(html, page_key, reload)
+
+    def prerender_due(self) -> Optional[datetime]:
+        """ When the next slot should be pre-rendered, or None if it already has been """
+        start = self.scheduler.next_slot_start
+        if not settings["prerender_lead"] or start is None or start == self.prerendered_start:
+            return None
+        return start - timedelta(seconds=settings["prerender_lead"])
+
+    def invalidate_prerender(self, reason=None):
+        """ Render the next slot again, e.g. because the schedule changed. The viewer only swaps in the pre-rendered
+        page if it matches what's rendered at the start of the slot, so a stale page is never shown, but re-rendering
+        keeps the swap instant """
+        logger.debug(f"Pre-rendered slot invalidated: {reason}")
+        self.prerendered = None
+        self.prerendered_start = None
+
+    def prerender_next_slot(self):
+        """ Render the next slot a little before it starts, so the viewer can load it off-screen and swap it in """
+        slot, start = self.scheduler.next_slot, self.scheduler.next_slot_start
+        self.prerendered_start = start
+        if slot is None or slot is self.scheduler.current_slot:
+            return
+        events = self.scheduler.event_index.active_at(start + TRANSITION_MARGIN)
+        html = self.render_display_html(slot, events)
+        prerendered = (self.page_key(slot), html)
+        if prerendered != self.prerendered:
+            logger.debug(f"Pre-rendering slot {slot.uuid}, starting at {start}")
+            # noinspection PyUnresolvedReferences
+            self.prerender_template.emit(html, prerendered[0])
+            self.prerendered = prerendered
+
+    def evict_template(self, template_uuid):
+        self.render_cache.evict(template_uuid)
+        self.invalidate_prerender("template updated")
+        self.wake("template updated")
+
+    def page_key(self, schedule_slot: ScheduleSlot) -> str:
+        template_uuid = schedule_slot.template_uuid
+        return f"{template_uuid}:{self.render_cache.template_hash(template_uuid)}"
 
     def display_loop(self):
+        # Clear before checking anything, so a wakeup that arrives mid-loop isn't lost
+        self.wakeup.clear()
+        if self.showing_hotspot:
+            self.wakeup.wait(MAX_TICK_DELAY)  # Woken when the hotspot page closes
+            return
+        started = perf_counter()
+        if self.clock_changed:
+            # NTP has just set the clock, which may have jumped
+            self.clock_changed = False
+            self.scheduler.calculate_current_slot()
+            self.scheduler.refresh_needed = True
+            self.invalidate_prerender("clock changed")
         r = connect_to_redis()
+        status = get_device_status(r)
         if self.scheduler.current_slot is None:
             logger.info('Playlist is empty. Sleeping for %s seconds', EMPTY_PL_DELAY)
-            html = default_templates_env.get_template("loading.html").render()
-            self.show_default_template(html)
-            sleep(EMPTY_PL_DELAY)
+            if not self.showing_snapshot:
+                html = default_templates_env.get_template("loading.html").render()
+                self.show_default_template(html)
+            waited = perf_counter()
+            self.wakeup.wait(EMPTY_PL_DELAY)
+            started += perf_counter() - waited  # Only time spent working counts
         else:
             if self.scheduler.event_active:
                 events = self.scheduler.active_events
             else:
                 events = []
-            if self.scheduler.refresh_needed or r.exists("refresh-browser"):
-                html = self.render_display_html(self.scheduler.current_slot, events)
-                self.show_user_template(html)
-                self.scheduler.refresh_needed = False
-                r.delete("refresh-browser")
-            banner_message = self.create_banner_message()
-            r.publish("banner_message", banner_message)
-            self.current_banner_message = banner_message
+            if self.scheduler.refresh_needed or status.refresh_browser:
+                try:
+                    html = self.render_display_html(self.scheduler.current_slot, events)
+                except Exception:
+                    if not self.showing_snapshot:
+                        raise
+                    # Probably a template the background sync hasn't fetched yet, so try again shortly
+                    logger.exception("Could not render the schedule, keeping the last known screen for now")
+                    waited = perf_counter()
+                    self.wakeup.wait(EMPTY_PL_DELAY)
+                    started += perf_counter() - waited
+                else:
+                    self.showing_snapshot = False
+                    # refresh-browser means an image file changed under the same name, which only a reload picks up
+                    self.show_user_template(html, self.page_key(self.scheduler.current_slot),
+                                            reload=status.refresh_browser)
+                    save_display_snapshot(html)
+                    self.scheduler.refresh_needed = False
+                    if status.refresh_browser:
+                        r.delete("refresh-browser")
+                        # Images may have changed under the same names, so the off-screen page must be loaded again
+                        self.invalidate_prerender("refresh-browser")
+            self.publish_banner(r, self.create_banner_message(status))
+            prerender_due = self.prerender_due()
+            if prerender_due and datetime.now() >= prerender_due:
+                self.prerender_next_slot()
 
-        if get_db_mtime() > self.scheduler.last_update_db_mtime:
-            self.scheduler.update_assets_from_db()
+        position = (self.scheduler.change_position, self.scheduler.last_update_db_mtime)
+        self.scheduler.apply_changes()
+        if (self.scheduler.change_position, self.scheduler.last_update_db_mtime) != position:
+            self.invalidate_prerender("schedule changed")
         self.scheduler.tick()
-        sleep(SCREEN_TICK_DELAY)
+        prerender_due = self.prerender_due()
+        DISPLAY_LOOP_SECONDS.observe(perf_counter() - started)
+        if self.scheduler.refresh_needed or (prerender_due and datetime.now() >= prerender_due):
+            return  # Render straight away
+        deadlines = [self.scheduler.next_transition(), banner_wording_changes_at(status), prerender_due]
+        self.wait_until(min(d for d in deadlines if d is not None))
+
+    def publish_banner(self, r, banner_message):
+        """ Publish the banner only when its text changes. It's also stored, so the local websocket server can send it
+        to pages that connect later """
+        if banner_message == self.current_banner_message:
+            return
+        with r.pipeline(transaction=False) as pipe:
+            pipe.set("banner-message", banner_message)
+            pipe.publish("banner_message", banner_message)
+            pipe.execute()
+        self.current_banner_message = banner_message
 
     def show_hotspot_page(self):
         r = connect_to_redis()
@@ -81,38 +287,41 @@ class DisplayHandler(QThread):
         logger.info("Displaying hotspot page")
         current_html = ""
         status = ""
-        # Enter a loop to update the display according to wifi-connect progress
+        # Update the display as wifi-connect progresses. wifi_manager publishes each change, so no polling
         show_error_message = False
-        while status != "success":
-            status = r.get("wifi-connect-status").decode('utf-8')
-            if status == "user-on-portal":
-                show_hotspot_connection_instructions = False
-                show_home_wifi_password_instructions = True
-                show_connecting_spinner = False
-            elif status == "connecting":
-                show_hotspot_connection_instructions = False
-                show_home_wifi_password_instructions = False
-                show_connecting_spinner = True
-                show_error_message = False
-            elif status == "user-error":
-                show_hotspot_connection_instructions = True
-                show_home_wifi_password_instructions = False
-                show_connecting_spinner = False
-                show_error_message = True
-            else:
-                show_hotspot_connection_instructions = True
-                show_home_wifi_password_instructions = False
-                show_connecting_spinner = False
-            new_html = default_templates_env.get_template("hotspot.html"). \
-                render(ssid="NoticeHome",
-                       show_hotspot_connection_instructions=show_hotspot_connection_instructions,
-                       connecting=show_connecting_spinner,
-                       error=show_error_message,
-                       show_home_wifi_password_instructions=show_home_wifi_password_instructions)
-            if new_html != current_html:
-                current_html = new_html
-                self.show_default_template(current_html)
-            sleep(0.2)
+        with StateSubscription([WIFI_CONNECT_STATUS]) as subscription:
+            while True:
+                status = subscription.read()[WIFI_CONNECT_STATUS]
+                if status == "success":
+                    return
+                if status == "user-on-portal":
+                    show_hotspot_connection_instructions = False
+                    show_home_wifi_password_instructions = True
+                    show_connecting_spinner = False
+                elif status == "connecting":
+                    show_hotspot_connection_instructions = False
+                    show_home_wifi_password_instructions = False
+                    show_connecting_spinner = True
+                    show_error_message = False
+                elif status == "user-error":
+                    show_hotspot_connection_instructions = True
+                    show_home_wifi_password_instructions = False
+                    show_connecting_spinner = False
+                    show_error_message = True
+                else:
+                    show_hotspot_connection_instructions = True
+                    show_home_wifi_password_instructions = False
+                    show_connecting_spinner = False
+                new_html = default_templates_env.get_template("hotspot.html"). \
+                    render(ssid="NoticeHome",
+                           show_hotspot_connection_instructions=show_hotspot_connection_instructions,
+                           connecting=show_connecting_spinner,
+                           error=show_error_message,
+                           show_home_wifi_password_instructions=show_home_wifi_password_instructions)
+                if new_html != current_html:
+                    current_html = new_html
+                    self.show_default_template(current_html)
+                subscription.wait(HOTSPOT_SAFETY_POLL)
 
     def device_pair(self):
         logger.info("Starting pairing")
@@ -147,6 +356,81 @@ class DisplayHandler(QThread):
         html = default_templates_env.get_template("error.html").render(message=error_message)
         self.show_default_template(html)
 
+    def wait_for_network(self, show_errors=True):
+        """ Wait for Wi-Fi manager and the internet, showing the hotspot page if Wi-Fi manager starts one, then set the
+        clock. With show_errors off, problems are only logged, so content already on screen stays there """
+        wm = wait_for_wifi_manager()
+
+        # Check to see if we have internet and if Wi-Fi manager is starting a hotspot
+        if wm:
+            while True:
+                state = wait_for_state([INTERNET_CONNECTED, WIFI_MANAGER_CONNECTING],
+                                       lambda s: s[INTERNET_CONNECTED] or s[WIFI_MANAGER_CONNECTING])
+                if state[INTERNET_CONNECTED]:
+                    break
+                self.showing_hotspot = True
+                try:
+                    self.show_hotspot_page()
+                finally:
+                    self.showing_hotspot = False
+                    self.scheduler.refresh_needed = True
+                    self.wake("hotspot page closed")
+        else:  # Wi-Fi manager has failed to start
+            if settings["refresh_token"] in [None, "None", ""]:
+                # If device is paired, continue anyway
+                logger.warning("Continuing without wifi setup")
+            elif show_errors:
+                # If device isn't paired, we can't continue
+                error_text = "Network error. Please try restarting your NoticeHome. If this persists, contact" \
+                             " Kenban support."
+                self.show_error_page(error_text)
+
+        # Check to see if we can reach the internet before proceeding
+        ping = wait_for_internet_ping(500, 0.1)
+        # Force an NTP update, in case we've been offline for a while and reject SSL certs
+        force_ntp_update()
+        self.clock_changed = True
+        self.wake("clock set")
+        if not ping and show_errors:
+            error_text = "Network error. Please try restarting your NoticeHome. If this persists, contact" \
+                         " Kenban support."
+            self.show_error_page(error_text)
+
+    def wait_for_network_in_background(self):
+        def wait():
+            # noinspection PyBroadException
+            try:
+                self.wait_for_network(show_errors=False)
+                logger.info("Network ready")
+            except Exception:
+                logger.exception("Error while waiting for the network")
+
+        threading.Thread(target=wait, name="network-startup", daemon=True).start()
+
+    def show_last_known_screen(self) -> bool:
+        """ Show the schedule from the local database, or failing that the last page shown before shutdown, without
+        waiting for the network. Returns False if there's nothing to show """
+        wait_for_redis(50, 0.1)  # Local, so only takes a moment
+        if self.scheduler.current_slot is not None:
+            # noinspection PyBroadException
+            try:
+                events = self.scheduler.active_events if self.scheduler.event_active else []
+                html = self.render_display_html(self.scheduler.current_slot, events)
+                self.show_user_template(html, self.page_key(self.scheduler.current_slot))
+                self.scheduler.refresh_needed = False
+                logger.info("Fast boot: showing the schedule from the local database")
+                return True
+            except Exception:
+                logger.exception("Could not render the local schedule")
+        html = load_display_snapshot()
+        if html:
+            self.show_user_template(html)
+            # Until the schedule can be rendered, rather than replacing it with the loading page
+            self.showing_snapshot = True
+            logger.info("Fast boot: showing the last page shown before shutdown")
+            return True
+        return False
+
     def run(self):
         # noinspection PyBroadException
         try:
@@ -154,37 +438,15 @@ class DisplayHandler(QThread):
             settings.load()
 
             r = connect_to_redis()
-            wm = wait_for_wifi_manager()
-
-            # Check to see if we have internet and if Wi-Fi manager is starting a hotspot
-            if wm:
-                while not r.getbit("internet-connected", 0):
-                    if r.getbit("wifi-manager-connecting", 0):
-                        self.show_hotspot_page()
-                    else:
-                        sleep(0.1)
-            else:  # Wi-Fi manager has failed to start
-                if settings["refresh_token"] in [None, "None", ""]:
-                    # If device is paired, continue anyway
-                    r = connect_to_redis()
-                    logger.warning("Continuing without wifi setup")
-                else:
-                    # If device isn't paired, we can't continue
-                    error_text = "Network error. Please try restarting your NoticeHome. If this persists, contact" \
-                                 " Kenban support."
-                    self.show_error_page(error_text)
-
-            # Check to see if we can reach the internet before proceeding
-            ping = wait_for_internet_ping(500, 0.1)
-            # Force an NTP update, in case we've been offline for a while and reject SSL certs
-            force_ntp_update()
-            if not ping:
-                error_text = "Network error. Please try restarting your NoticeHome. If this persists, contact" \
-                             " Kenban support."
-                self.show_error_page(error_text)
+            paired = settings["refresh_token"] not in [None, "None", ""]
+            if paired and self.show_last_known_screen():
+                # Content is already on screen, so the network can come up while the display loop runs
+                self.wait_for_network_in_background()
+            else:
+                self.wait_for_network()
 
             # If we don't have a refresh token, we need to pair the device
-            if settings["refresh_token"] in [None, "None", ""]:
+            if not paired:
                 r = connect_to_redis()
                 r.set("new-setup", 1, ex=3600)
                 self.device_pair()
@@ -196,7 +458,13 @@ class DisplayHandler(QThread):
                 logger.info(f"Device already paired")
 
             logger.debug('Entering infinite loop.')
-            r.set("rebooted", 1, ex=15)
+            start_redis_listener(DISPLAY_WAKEUP_CHANNEL, self.wake)
+            start_redis_listener(TEMPLATE_UPDATED_CHANNEL, self.evict_template)
+            r.set("rebooted", 1, ex=REBOOTED_BANNER_TIME)
+            # Redraw the banner once the "rebooted" flag expires
+            banner_timer = threading.Timer(REBOOTED_BANNER_TIME, self.wake, args=("rebooted flag expired",))
+            banner_timer.daemon = True
+            banner_timer.start()
             while True:
                 self.display_loop()
         except:
@@ -204,6 +472,7 @@ class DisplayHandler(QThread):
             error_text = "Error. Please try restarting your NoticeHome. If this persists, contact Kenban support."
             self.show_error_page(error_text)
 
+    @metrics.timed(RENDER_SECONDS)
     def render_display_html(self, schedule_slot: ScheduleSlot, events) -> str:
         if not schedule_slot:
             error_message = "Error. Please try restarting your NoticeHome. If this persists, contact Kenban support."
@@ -218,23 +487,20 @@ class DisplayHandler(QThread):
         if not schedule_slot.display_text:
             schedule_slot.display_text = ""
 
-        html = user_templates_env.get_template(schedule_slot.template_uuid).render(
-            slot=schedule_slot,
-            events=events)
-        return html
+        return self.render_cache.render(schedule_slot, events)
 
     def confirm_setup_completion(self):
         url = settings['server_address'] + settings['setup_complete'] + "/" + settings["device_uuid"]
         kenban_server_request(url=url, method='POST', data={"complete": True}, headers=get_auth_header())
 
-    def create_banner_message(self):
+    def create_banner_message(self, status: DeviceStatus = None):
         """ Build banner message text for error messages, based on flags that have been set in redis """
-        r = connect_to_redis()
+        if status is None:
+            status = get_device_status(connect_to_redis())
 
-        if not r.getbit("internet-connected", offset=0):
-            if r.exists("last-connected"):
-                last_connected = float(r.get("last-connected").decode('utf-8'))
-                last_connected = datetime.fromtimestamp(last_connected)
+        if not status.internet_connected:
+            if status.last_connected is not None:
+                last_connected = datetime.fromtimestamp(status.last_connected)
                 last_connected_text = humanize.naturaltime(last_connected)
                 if "second" in last_connected_text:
                     last_connected_text = "less than a minute ago"
@@ -243,16 +509,15 @@ class DisplayHandler(QThread):
                        f"Restart device to connect to a new Wi-Fi Network"
             return "No internet connection found"
 
-        elif not r.getbit("websocket-connected", offset=0):
-            if r.exists("websocket-dc-timestamp"):
-                last_ws_connected = float(r.get("websocket-dc-timestamp").decode('utf-8'))
-                last_ws_connected = datetime.fromtimestamp(last_ws_connected)
+        elif not status.websocket_connected:
+            if status.websocket_dc_timestamp is not None:
+                last_ws_connected = datetime.fromtimestamp(status.websocket_dc_timestamp)
                 last_ws_connected_text = humanize.naturaltime(last_ws_connected)
                 if "second" in last_ws_connected_text:
                     last_ws_connected_text = "less than a minute ago"
                 return f"Unable to reach Kenban server. Last sync {last_ws_connected_text}"
             return f"Unable to reach Kenban server."
-        elif r.exists("rebooted"):
+        elif status.rebooted:
             if settings["screen_name"] not in [None, "", "None"]:
                 return f"Screen name = {settings['screen_name']}"
             else:
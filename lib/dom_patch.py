@@ -0,0 +1,83 @@
+import json
+
+# Brings the live page in line with a new render of the same template, without reloading it. Only the parts that
+# differ between the previous render and the new one are touched, so anything the page's own scripts have changed
+# since it loaded (the banner, a clock) is left alone, images that haven't changed aren't decoded again and running
+# scripts keep their references to elements. Evaluates to false if the page can't be patched safely, because the
+# scripts changed or the page isn't the one that was rendered, in which case the caller should reload it instead.
+PATCH_SCRIPT = """
+(function (oldHtml, newHtml) {
+    var parser = new DOMParser();
+    var oldDoc = parser.parseFromString(oldHtml, "text/html");
+    var newDoc = parser.parseFromString(newHtml, "text/html");
+
+    function scripts(doc) {
+        return Array.prototype.map.call(doc.querySelectorAll("script"), function (s) {
+            return s.src + "\\n" + s.text;
+        }).join("\\n\\n");
+    }
+    // Scripts inserted by a patch wouldn't run, and the ones already running would be out of date
+    if (scripts(oldDoc) !== scripts(newDoc) || document.body === null) {
+        return false;
+    }
+
+    function patchAttributes(live, oldNode, newNode) {
+        var i, attr;
+        for (i = 0; i < oldNode.attributes.length; i++) {
+            attr = oldNode.attributes[i];
+            if (!newNode.hasAttribute(attr.name)) {
+                live.removeAttribute(attr.name);
+            }
+        }
+        for (i = 0; i < newNode.attributes.length; i++) {
+            attr = newNode.attributes[i];
+            if (oldNode.getAttribute(attr.name) !== attr.value) {
+                live.setAttribute(attr.name, attr.value);
+            }
+        }
+    }
+
+    function patch(live, oldNode, newNode) {
+        if (oldNode.isEqualNode(newNode)) {
+            return;
+        }
+        if (oldNode.nodeName !== newNode.nodeName || live.nodeName !== oldNode.nodeName) {
+            live.parentNode.replaceChild(document.importNode(newNode, true), live);
+            return;
+        }
+        if (newNode.nodeType !== Node.ELEMENT_NODE) {
+            live.nodeValue = newNode.nodeValue;
+            return;
+        }
+        patchAttributes(live, oldNode, newNode);
+        var liveChildren = Array.prototype.slice.call(live.childNodes);
+        var oldChildren = oldNode.childNodes;
+        var newChildren = newNode.childNodes;
+        if (liveChildren.length === oldChildren.length && oldChildren.length === newChildren.length) {
+            for (var i = 0; i < newChildren.length; i++) {
+                patch(liveChildren[i], oldChildren[i], newChildren[i]);
+            }
+            return;
+        }
+        // Items were added or removed (e.g. an event started), so replace this element's contents
+        var fragment = document.createDocumentFragment();
+        for (var j = 0; j < newChildren.length; j++) {
+            fragment.appendChild(document.importNode(newChildren[j], true));
+        }
+        while (live.firstChild) {
+            live.removeChild(live.firstChild);
+        }
+        live.appendChild(fragment);
+    }
+
+    patchAttributes(document.documentElement, oldDoc.documentElement, newDoc.documentElement);
+    patch(document.head, oldDoc.head, newDoc.head);
+    patch(document.body, oldDoc.body, newDoc.body);
+    return true;
+})(%s, %s)
+"""
+
+
+def patch_script(old_html: str, new_html: str) -> str:
+    """ Javascript that patches a page rendered from old_html to match new_html """
+    return PATCH_SCRIPT % (json.dumps(old_html), json.dumps(new_html))
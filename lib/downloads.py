@@ -0,0 +1,171 @@
+import hashlib
+import logging.config
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from timeit import default_timer as timer
+from typing import List, NamedTuple, Optional, Tuple
+
+import requests
+
+from lib import metrics
+from lib.http_client import http_request
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+DOWNLOAD_WORKERS = 4
+CHUNK_SIZE = 64 * 1024
+PART_SUFFIX = ".part"
+STALE_PART_AGE = 3600  # secs. Older .part files are left over from a crash
+
+DOWNLOADS = metrics.counter("kenban_downloads_total", "Files downloaded", result="ok")
+DOWNLOADS_NOT_MODIFIED = metrics.counter("kenban_downloads_total", "Files downloaded", result="not_modified")
+DOWNLOAD_FAILURES = metrics.counter("kenban_downloads_total", "Files downloaded", result="failed")
+DOWNLOADED_BYTES = metrics.counter("kenban_downloaded_bytes_total", "Bytes of files downloaded successfully")
+
+
+class DownloadResult(NamedTuple):
+    url: str
+    path: str
+    size: int
+    seconds: float
+    error: Optional[str] = None
+    not_modified: bool = False  # The server returned 304, so the existing file was kept
+    sha256: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def throughput(self):
+        """ Bytes per second """
+        return self.size / self.seconds if self.seconds else 0
+
+
+class DownloadStats(object):
+    """ Per-download results and totals for a batch of downloads """
+
+    def __init__(self):
+        self.results: List[DownloadResult] = []
+        self.started = timer()
+        self.finished = None
+
+    @property
+    def total_bytes(self):
+        return sum(r.size for r in self.results if r.ok)
+
+    @property
+    def failures(self):
+        return [r for r in self.results if not r.ok]
+
+    @property
+    def unchanged(self):
+        return [r for r in self.results if r.not_modified]
+
+    @property
+    def elapsed(self):
+        return (self.finished or timer()) - self.started
+
+    @property
+    def throughput(self):
+        """ Bytes per second across the whole batch, including time spent waiting on the server """
+        return self.total_bytes / self.elapsed if self.elapsed else 0
+
+    def summary(self):
+        downloaded = len(self.results) - len(self.failures) - len(self.unchanged)
+        return f"Downloaded {downloaded}/{len(self.results)} files ({len(self.unchanged)} unchanged), " \
+               f"{self.total_bytes / 1e6:.1f} MB in {self.elapsed:.1f}s ({self.throughput / 1e3:.0f} KB/s)"
+
+
+def file_sha256(fp: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def download_file(url: str, fp: str, headers: dict = None) -> DownloadResult:
+    """ Stream url to fp. The body goes to a temp file in the same folder, which is only renamed over fp once it has
+    been completely written and its size checked, so a crash part way through never leaves a truncated file.
+    Pass If-None-Match/If-Modified-Since in headers to leave fp alone if it hasn't changed on the server """
+    start = timer()
+    folder = os.path.dirname(fp)
+    os.makedirs(folder, exist_ok=True)
+    part = tempfile.NamedTemporaryFile(dir=folder, prefix=f".{os.path.basename(fp)}.", suffix=PART_SUFFIX,
+                                       delete=False)
+    size = 0
+    sha256 = hashlib.sha256()
+    try:
+        with part, http_request("GET", url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code == 304:
+                os.remove(part.name)
+                DOWNLOADS_NOT_MODIFIED.inc()
+                return DownloadResult(url=url, path=fp, size=0, seconds=timer() - start, not_modified=True)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                part.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+            part.flush()
+            os.fsync(part.fileno())
+        expected_size = response.headers.get("Content-Length")
+        if size == 0:
+            raise ValueError("Empty response")
+        # With a Content-Encoding, Content-Length is the compressed size so can't be compared
+        if expected_size and "Content-Encoding" not in response.headers and int(expected_size) != size:
+            raise ValueError(f"Expected {expected_size} bytes, got {size}")
+        os.chmod(part.name, 0o644)  # Temp files are created private
+        os.replace(part.name, fp)
+    except (requests.exceptions.RequestException, OSError, ValueError) as e:
+        logging.error(f"Failed to download {url}: {e}")
+        try:
+            os.remove(part.name)
+        except OSError:
+            pass
+        DOWNLOAD_FAILURES.inc()
+        return DownloadResult(url=url, path=fp, size=size, seconds=timer() - start, error=str(e))
+    result = DownloadResult(url=url, path=fp, size=size, seconds=timer() - start, sha256=sha256.hexdigest(),
+                            etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+    logging.debug(f"Downloaded {url} to {fp}: {size} bytes in {result.seconds:.2f}s "
+                  f"({result.throughput / 1e3:.0f} KB/s)")
+    DOWNLOADS.inc()
+    DOWNLOADED_BYTES.inc(size)
+    return result
+
+
+def download_files(downloads: List[Tuple], workers=DOWNLOAD_WORKERS) -> DownloadStats:
+    """ Download (url, fp) or (url, fp, headers) tuples, a few at a time """
+    stats = DownloadStats()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as executor:
+        for result in executor.map(lambda d: download_file(*d), downloads):
+            stats.results.append(result)
+    stats.finished = timer()
+    return stats
+
+
+def remove_stale_parts(folder: str):
+    """ Delete temp files left behind by downloads that were interrupted by a crash or power cut """
+    now = time()
+    for name in os.listdir(folder):
+        fp = os.path.join(folder, name)
+        if name.endswith(PART_SUFFIX) and now - os.path.getmtime(fp) > STALE_PART_AGE:
+            logging.info(f"Removing incomplete download {fp}")
+            os.remove(fp)
+
+
+def link_into_place(src: str, dest: str):
+    """ Point dest at the same file as src, replacing whatever was there atomically """
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return
+    tmp = f"{dest}.{os.getpid()}.link"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)  # Different filesystem
+    os.replace(tmp, dest)
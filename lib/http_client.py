@@ -0,0 +1,75 @@
+import logging.config
+import os
+import random
+import threading
+from time import sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from settings import settings
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+POOL_SIZE = 8  # Connections kept open per host. At least as many as there are download threads
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+RETRY_STATUSES = {429, 502, 503, 504}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """ The process's shared session, so connections to the server are kept alive and reused instead of paying for a
+    new TCP and TLS handshake on every request. Recreated after a fork, as sockets can't be shared between processes """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+def backoff_delay(attempt: int) -> float:
+    """ Exponential backoff with full jitter, so devices that lost the server at the same time don't retry in step """
+    return random.uniform(0, settings["http_backoff"] / 1000 * 2 ** attempt)
+
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """ Make a request through the shared session with the configured timeouts. Idempotent requests are retried on
+    connection errors, timeouts and 429/502/503/504 responses. Other errors are left for the caller to handle, as they
+    would be with requests.request """
+    kwargs.setdefault("timeout", (settings["http_connect_timeout"], settings["http_read_timeout"]))
+    retries = settings["http_retries"] if method.upper() in IDEMPOTENT_METHODS else 0
+    session = get_session()
+    for attempt in range(retries + 1):
+        try:
+            response = session.request(method=method, url=url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning(f"{method} {url} failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+            delay = backoff_delay(attempt)
+            logging.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            response.close()
+        sleep(delay)
+
+
+def pool_stats() -> dict:
+    """ How many requests reused a pooled connection (hits) rather than opening a new one (misses) """
+    request_count = connection_count = 0
+    for adapter in {id(a): a for a in get_session().adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            request_count += pool.num_requests
+            connection_count += pool.num_connections
+    return {"requests": request_count, "hits": request_count - connection_count, "misses": connection_count}
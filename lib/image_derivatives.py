@@ -0,0 +1,162 @@
+import logging.config
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from lib.downloads import file_sha256, link_into_place, remove_stale_parts
+from settings import settings
+
+try:
+    from PIL import Image, ImageOps, ImageSequence, features
+except ImportError:
+    # Devices set up before Pillow was added to requirements.txt. Images are shown as downloaded
+    Image = None
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+# Downloaded images are kept as they are in original_images_folder. What templates see in images_folder is a
+# derivative sized to the display, so the browser doesn't have to decode a multi-megapixel photo and scale it down
+# every time a page loads. Derivatives are cached in image_derivatives_folder by the hash of the original, and
+# hard-linked into images_folder, so an unchanged original is never processed twice.
+DERIVATIVE_VERSION = 1  # Bump when the processing changes, so existing derivatives are regenerated
+DERIVATIVE_WORKERS = 2  # Leave cores free for the viewer
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+# Already cheap to decode, so only re-encoded if they need shrinking or rotating
+EFFICIENT_FORMATS = {"JPEG", "PNG", "WEBP"}
+EXIF_ORIENTATION = 0x0112
+MAX_ANIMATION_BYTES = 128 * 1024 * 1024  # Decoded size of all the frames. Bigger animations are left as they are
+
+
+def display_size() -> Tuple[int, int]:
+    width, height = settings["resolution"].lower().split("x")
+    return int(width), int(height)
+
+
+def derivative_path(source_sha256: str, size: Tuple[int, int]) -> str:
+    return os.path.join(settings["image_derivatives_folder"],
+                        f"{source_sha256}-{size[0]}x{size[1]}-v{DERIVATIVE_VERSION}")
+
+
+def save_still(image, dest: str):
+    if image.mode in ("P", "LA", "PA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+    if features.check("webp"):
+        image.save(dest, "WEBP", quality=WEBP_QUALITY, method=4)
+    elif image.mode == "RGBA":
+        image.save(dest, "PNG", optimize=True)
+    else:
+        image.save(dest, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+
+
+def save_animation(image, dest: str, size: Tuple[int, int]) -> bool:
+    """ Convert an animated GIF to animated WebP, which is several times smaller and has full colour """
+    scale = min(1.0, size[0] / image.width, size[1] / image.height)
+    if image.n_frames * image.width * image.height * scale * scale * 4 > MAX_ANIMATION_BYTES:
+        logging.info(f"Animation too large to convert ({image.n_frames} frames)")
+        return False
+    frames, durations = [], []
+    for frame in ImageSequence.Iterator(image):
+        durations.append(frame.info.get("duration", 100))
+        frame = frame.convert("RGBA")
+        frame.thumbnail(size, Image.LANCZOS)
+        frames.append(frame)
+    try:
+        frames[0].save(dest, "WEBP", save_all=True, append_images=frames[1:], duration=durations,
+                       loop=image.info.get("loop", 0), quality=WEBP_QUALITY, method=4)
+    except (OSError, ValueError, KeyError) as e:
+        logging.info(f"Can't write animated WebP: {e}")
+        return False
+    return True
+
+
+def make_derivative(src: str, dest: str, size: Tuple[int, int]) -> bool:
+    """ Write a version of src that fits within size to dest. Returns False if src is best shown as it is """
+    with Image.open(src) as image:
+        if getattr(image, "is_animated", False):
+            return image.format == "GIF" and save_animation(image, dest, size)
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        rotated = orientation in (5, 6, 7, 8)  # Width and height are swapped once the orientation is applied
+        width, height = (image.height, image.width) if rotated else image.size
+        if image.format in EFFICIENT_FORMATS and orientation == 1 and width <= size[0] and height <= size[1]:
+            return False
+        # Let the JPEG decoder scale down by a power of two as it decodes, which is much faster than decoding in full
+        image.draft("RGB", (size[1], size[0]) if rotated else size)
+        derivative = ImageOps.exif_transpose(image)
+        derivative.thumbnail(size, Image.LANCZOS)
+        save_still(derivative, dest)
+    return True
+
+
+def cached_derivative(original: str, source_sha256: str) -> str:
+    """ The path of the file to show for original, creating a derivative if one isn't cached """
+    if Image is None or not settings["image_derivatives"]:
+        return original
+    size = display_size()
+    fp = derivative_path(source_sha256, size)
+    if os.path.exists(fp):
+        return fp
+    os.makedirs(settings["image_derivatives_folder"], exist_ok=True)
+    part = tempfile.NamedTemporaryFile(dir=settings["image_derivatives_folder"], prefix=".", suffix=".part",
+                                       delete=False)
+    part.close()
+    try:
+        if not make_derivative(original, part.name, size):
+            os.remove(part.name)
+            return original
+    except Exception as e:
+        # Pillow raises all sorts for corrupt or unusual files. The original is still worth a try in the browser
+        logging.warning(f"Could not make a derivative of {original}: {e}")
+        os.remove(part.name)
+        return original
+    os.chmod(part.name, 0o644)
+    os.replace(part.name, fp)
+    logging.debug(f"Made derivative of {original}: {os.path.getsize(original)} -> {os.path.getsize(fp)} bytes")
+    return fp
+
+
+def publish_image(image_uuid: str, source_sha256: str = None) -> Optional[str]:
+    """ Put the version of a downloaded image that templates should show into images_folder """
+    original = os.path.join(settings["original_images_folder"], image_uuid)
+    published = os.path.join(settings["images_folder"], image_uuid)
+    os.makedirs(settings["original_images_folder"], exist_ok=True)
+    os.makedirs(settings["images_folder"], exist_ok=True)
+    if not os.path.exists(original):
+        if not os.path.exists(published):
+            return None
+        # Downloaded before originals were kept separately
+        link_into_place(published, original)
+    try:
+        fp = cached_derivative(original, source_sha256 or file_sha256(original))
+        link_into_place(fp, published)
+    except OSError as e:
+        logging.error(f"Failed to publish image {image_uuid}: {e}")
+        return None
+    return published
+
+
+def publish_images(images: List[Tuple[str, Optional[str]]]) -> List[Optional[str]]:
+    """ Publish (uuid, sha256) pairs, a couple at a time. Processing runs in the sync process, never the viewer """
+    with ThreadPoolExecutor(max_workers=DERIVATIVE_WORKERS, thread_name_prefix="derivative") as executor:
+        return list(executor.map(lambda i: publish_image(*i), images))
+
+
+def remove_unused_derivatives() -> int:
+    """ Delete derivatives that aren't linked into images_folder any more, e.g. because the original changed or the
+    resolution setting did. Returns bytes freed """
+    folder = settings["image_derivatives_folder"]
+    if not os.path.isdir(folder):
+        return 0
+    remove_stale_parts(folder)
+    freed = 0
+    for name in os.listdir(folder):
+        fp = os.path.join(folder, name)
+        stat = os.stat(fp)
+        if not name.startswith(".") and stat.st_nlink == 1:
+            logging.debug(f"Removing unused derivative {fp}")
+            os.remove(fp)
+            freed += stat.st_size
+    return freed
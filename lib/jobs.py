@@ -0,0 +1,176 @@
+import fcntl
+import json
+import logging.config
+import os
+import random
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from lib.utils import connect_to_redis, start_redis_listener
+from settings import settings
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+# Publish a job's name here to run it straight away, e.g. `redis-cli publish run-job full_sync`
+JOB_TRIGGER_CHANNEL = "run-job"
+MAX_WAIT = 3600  # secs. Re-check the schedule at least this often, in case the clock jumps
+
+
+def parse_cron_field(field, first: int, last: int) -> List[int]:
+    """ The values matched by a crontab-style field: "*", "*/n", a number, or a comma separated list of numbers """
+    field = str(field)
+    if field == "*":
+        return list(range(first, last + 1))
+    if field.startswith("*/"):
+        return list(range(first, last + 1, int(field[2:])))
+    values = sorted(int(v) for v in field.split(","))
+    if not all(first <= v <= last for v in values):
+        raise ValueError(f"{field} is outside {first}-{last}")
+    return values
+
+
+class CronSchedule(object):
+    """ Times matching crontab-style minute, hour and day of week fields, shifted by up to `jitter` so that devices
+    don't all hit the server at once. The shift is fixed for each device and job, so it doesn't move on restart.
+    Days of the week count from 0 = Monday """
+
+    def __init__(self, minute="*", hour="*", day_of_week="*", jitter: timedelta = timedelta(0), seed=""):
+        self.minutes = parse_cron_field(minute, 0, 59)
+        self.hours = parse_cron_field(hour, 0, 23)
+        self.days_of_week = parse_cron_field(day_of_week, 0, 6)
+        self.offset = timedelta(seconds=random.Random(seed).uniform(0, jitter.total_seconds()))
+
+    def next_run(self, after: datetime) -> datetime:
+        """ The first run time strictly after `after` """
+        shifted = after - self.offset
+        for days in range(8):
+            day = shifted.date() + timedelta(days)
+            if day.weekday() not in self.days_of_week:
+                continue
+            for hour in self.hours:
+                for minute in self.minutes:
+                    run = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour, minutes=minute)
+                    if run > shifted:
+                        return run + self.offset
+        raise ValueError("Schedule never matches")
+
+
+class Job(object):
+    """ Without a schedule, a job only runs when triggered """
+
+    def __init__(self, name: str, func: Callable, schedule: Optional[CronSchedule] = None):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+
+
+class JobRunner(object):
+    """ Runs jobs on their schedules in a background thread, one at a time. When each job last ran is saved to disk, so
+    a run missed while the device was off happens as soon as it's back on. Only one runner can hold the state file's
+    lock, so starting a second process doesn't run everything twice """
+
+    def __init__(self, jobs: List[Job], state_file: str = None):
+        self.jobs: Dict[str, Job] = {job.name: job for job in jobs}
+        self.state_file = state_file or settings["jobs_state"]
+        self.last_runs: Dict[str, datetime] = {}
+        self.triggered: List[str] = []
+        self.wakeup = threading.Event()
+        self.lock_file = None
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        self.last_runs = {name: datetime.fromisoformat(t) for name, t in state.items() if name in self.jobs}
+        for name in self.jobs:
+            if name not in self.last_runs:
+                # Never run here before, so start counting from now rather than running straight away
+                self.last_runs[name] = datetime.now()
+        self.save_state()
+
+    def save_state(self):
+        state = {name: t.isoformat() for name, t in self.last_runs.items()}
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.state_file), prefix=".jobs.",
+                                         delete=False) as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, self.state_file)
+
+    def acquire_lock(self) -> bool:
+        # flock is released by the kernel if the process dies, so a crash never leaves a stale lock
+        self.lock_file = open(self.state_file + ".lock", "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        return True
+
+    def next_run(self, name: str) -> Optional[datetime]:
+        schedule = self.jobs[name].schedule
+        return schedule.next_run(self.last_runs[name]) if schedule else None
+
+    def trigger(self, name):
+        """ Run a job as soon as the runner is free, whatever its schedule """
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        if name not in self.jobs:
+            logging.warning(f"Ignoring trigger for unknown job {name}")
+            return
+        logging.info(f"Job {name} triggered")
+        self.triggered.append(name)
+        self.wakeup.set()
+
+    def run_job(self, name: str):
+        logging.info(f"Running job {name}")
+        started = datetime.now()
+        # noinspection PyBroadException
+        try:
+            self.jobs[name].func()
+        except Exception:
+            logging.exception(f"Job {name} failed")
+        # Recorded even if it failed, so a broken job doesn't run over and over
+        self.last_runs[name] = started
+        self.save_state()
+        logging.info(f"Job {name} finished in {(datetime.now() - started).total_seconds():.0f}s")
+
+    def run_pending(self) -> Optional[datetime]:
+        """ Run any triggered or due jobs. Returns when the next job is due """
+        while self.triggered:
+            self.run_job(self.triggered.pop(0))
+        for name in self.jobs:
+            next_run = self.next_run(name)
+            if next_run and next_run <= datetime.now():
+                self.run_job(name)
+        return min((t for t in map(self.next_run, self.jobs) if t), default=None)
+
+    def loop(self):
+        while True:
+            self.wakeup.clear()
+            next_run = self.run_pending()
+            timeout = MAX_WAIT if next_run is None else (next_run - datetime.now()).total_seconds()
+            self.wakeup.wait(min(max(timeout, 0), MAX_WAIT))
+
+    def start(self) -> bool:
+        """ Start running jobs in a background thread. Returns False if another process is already running them """
+        if not self.acquire_lock():
+            logging.warning("Jobs are already being run by another process")
+            return False
+        self.load_state()
+        for name in self.jobs:
+            if self.jobs[name].schedule:
+                logging.info(f"Job {name} last ran at {self.last_runs[name]}, next run at {self.next_run(name)}")
+        start_redis_listener(JOB_TRIGGER_CHANNEL, self.trigger)
+        threading.Thread(target=self.loop, name="job-runner", daemon=True).start()
+        return True
+
+
+def trigger_job(name: str):
+    """ Ask whichever process is running jobs to run one now """
+    connect_to_redis().publish(JOB_TRIGGER_CHANNEL, name)
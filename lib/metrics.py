@@ -0,0 +1,239 @@
+import abc
+import atexit
+import bisect
+import logging.config
+import os
+import tempfile
+import threading
+from functools import wraps
+from time import perf_counter, sleep, time
+from typing import Dict, Iterator, List, Tuple
+
+import redis
+
+from lib.utils import connect_to_redis
+from settings import settings
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+# Counters, gauges and histograms kept in memory by each process, and written out every metrics_interval secs by a
+# background thread: as a Prometheus textfile in metrics_folder, for node_exporter's textfile collector, and to the redis
+# hash metrics:<process>. Recording a value is an increment under a lock, so it's cheap enough for the display loop.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # secs
+SLOW_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)  # secs, for syncs and downloads
+REDIS_KEY = "metrics:{process}"
+
+_metrics: Dict[Tuple[str, Tuple], "Metric"] = {}
+_metrics_lock = threading.Lock()
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: Dict[str, str]):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        """ (name, labels, value) of each line the metric is exported as """
+
+
+class Counter(Metric):
+    """ A count that only goes up, e.g. of reconnections or bytes downloaded """
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels):
+        super(Counter, self).__init__(name, documentation, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge(Metric):
+    """ A value that can go up and down, e.g. a hit rate, set to its latest reading """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels):
+        super(Gauge, self).__init__(name, documentation, labels)
+        self.value = 0
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Histogram(Metric):
+    """ Counts of observations, e.g. durations, in buckets, plus their total """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last is for values above every bucket
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self) -> "Timer":
+        """ Observe how long a with block takes """
+        return Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield f"{self.name}_bucket", dict(self.labels, le=format_value(float(bound))), cumulative
+        cumulative += counts[-1]
+        yield f"{self.name}_bucket", dict(self.labels, le="+Inf"), cumulative
+        yield f"{self.name}_sum", self.labels, total
+        yield f"{self.name}_count", self.labels, cumulative
+
+
+class Timer(object):
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start)
+
+
+def _register(cls, name, documentation, labels, **kwargs):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        if key not in _metrics:
+            _metrics[key] = cls(name, documentation, labels, **kwargs)
+        return _metrics[key]
+
+
+def counter(name: str, documentation: str, **labels) -> Counter:
+    """ The counter with this name and labels, created the first time it's asked for """
+    return _register(Counter, name, documentation, labels)
+
+
+def gauge(name: str, documentation: str, **labels) -> Gauge:
+    return _register(Gauge, name, documentation, labels)
+
+
+def histogram(name: str, documentation: str, buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+    return _register(Histogram, name, documentation, labels, buckets=buckets)
+
+
+def timed(hist: Histogram):
+    """ Decorator observing how long each call takes, whether or not it raises """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with hist.time():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def collect() -> List[Metric]:
+    with _metrics_lock:
+        return sorted(_metrics.values(), key=lambda m: m.name)
+
+
+def render_prometheus(process: str) -> str:
+    """ Every metric in the Prometheus text format, labelled with the process that recorded it """
+    lines = []
+    documented = set()
+    for metric in collect():
+        if metric.name not in documented:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            documented.add(metric.name)
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(dict(labels, process=process))} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def redis_fields() -> Dict[str, str]:
+    fields = {}
+    for metric in collect():
+        for name, labels, value in metric.samples():
+            fields[name + format_labels(labels)] = format_value(value)
+    return fields
+
+
+def write_textfile(process: str):
+    folder = settings["metrics_folder"]
+    os.makedirs(folder, exist_ok=True)
+    # node_exporter only reads *.prom files, so the temp file mustn't end in .prom until it's complete
+    with tempfile.NamedTemporaryFile("w", dir=folder, prefix=f".kenban_{process}.", delete=False) as f:
+        f.write(render_prometheus(process))
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, os.path.join(folder, f"kenban_{process}.prom"))
+
+
+def write_redis(process: str):
+    fields = redis_fields()
+    fields["updated_at"] = format_value(time())
+    connect_to_redis().hset(REDIS_KEY.format(process=process), mapping=fields)
+
+
+def export(process: str):
+    """ Write the current values out. Failures are only logged, so metrics can never take the process down """
+    try:
+        write_textfile(process)
+    except OSError as e:
+        logging.warning(f"Could not write metrics textfile: {e}")
+    try:
+        write_redis(process)
+    except redis.exceptions.ConnectionError:
+        logging.debug("Could not write metrics to redis")
+
+
+def start_exporter(process: str, interval: float = None) -> threading.Thread:
+    """ Export every interval secs from a daemon thread, and once more on exit """
+    interval = interval or settings["metrics_interval"]
+
+    def loop():
+        while True:
+            sleep(interval)
+            # noinspection PyBroadException
+            try:
+                export(process)
+            except Exception:
+                logging.exception("Error exporting metrics")
+
+    atexit.register(export, process)
+    thread = threading.Thread(target=loop, name="metrics-exporter", daemon=True)
+    thread.start()
+    return thread
@@ -1,16 +1,33 @@
-from sqlalchemy import create_engine, Column, String, Time, DateTime, Boolean, Integer
+import logging.config
+
+from sqlalchemy import create_engine, event, text, Column, String, Time, DateTime, Boolean, Integer, Index
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 from settings import settings
 
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
 db_url = "sqlite:///" + settings["database"]
-engine = create_engine(db_url, echo=False)
+engine = create_engine(db_url, echo=False, connect_args={"timeout": settings["sqlite_busy_timeout"] / 1000})
 Base = declarative_base()
 Session = sessionmaker(engine)
 
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings['sqlite_journal_mode']}")
+    cursor.execute(f"PRAGMA synchronous={settings['sqlite_synchronous']}")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings['sqlite_busy_timeout'])}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings['sqlite_mmap_size'])}")
+    cursor.close()
+
+
 class ScheduleSlot(Base):
     __tablename__ = "schedule_slot"
+    __table_args__ = (
+        Index("ix_schedule_slot_weekday_start_time", "weekday", "start_time"),
+    )
     uuid = Column(String, primary_key=True)
     template_uuid = Column(String)
     foreground_image_uuid = Column(String)
@@ -22,9 +39,60 @@ class ScheduleSlot(Base):
 
 class Event(Base):
     __tablename__ = "event"
+    __table_args__ = (
+        Index("ix_event_event_start", "event_start"),
+        Index("ix_event_event_end", "event_end"),
+    )
     uuid = Column(String, primary_key=True)
     foreground_image_uuid = Column(String)
     display_text = Column(String)
     event_start = Column(DateTime)
     event_end = Column(DateTime)
     override = Column(Boolean)
+
+
+class Asset(Base):
+    """ The manifest of downloaded image and template files, used to make conditional requests when syncing and to
+    check files haven't been corrupted. Also the index of the asset store (see lib/asset_store.py), mapping each uuid
+    to the blob holding its content """
+    __tablename__ = "asset"
+    kind = Column(String, primary_key=True)  # "image" or "template"
+    uuid = Column(String, primary_key=True)
+    sha256 = Column(String)
+    size = Column(Integer)
+    etag = Column(String)
+    last_modified = Column(String)
+    last_used = Column(DateTime)  # Last downloaded or needed by the schedule, for least-recently-used eviction
+    evicted = Column(Boolean, default=False)  # Deleted to stay under the quota. Fetched again if the schedule needs it
+
+
+def add_scheduler_indexes(connection):
+    for table in (ScheduleSlot.__table__, Event.__table__):
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+
+def add_asset_store_columns(connection):
+    existing = {row[1] for row in connection.execute(text("PRAGMA table_info(asset)"))}
+    for column in (Asset.__table__.c.last_used, Asset.__table__.c.evicted):
+        if column.name not in existing:
+            connection.execute(text(f"ALTER TABLE asset ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"))
+
+
+# Schema changes for databases created by older versions. create_all() only creates missing tables, so anything
+# added to an existing table goes here. Never edit or reorder these, only append
+MIGRATIONS = [
+    add_scheduler_indexes,
+    add_asset_store_columns,
+]
+
+
+def init_db():
+    """ Create any missing tables, then bring an existing database up to date using SQLite's user_version """
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        version = connection.execute(text("PRAGMA user_version")).scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info(f"Migrating database to version {number}: {migration.__name__}")
+            migration(connection)
+            connection.execute(text(f"PRAGMA user_version={number}"))
@@ -0,0 +1,70 @@
+import hashlib
+import logging.config
+import os
+import threading
+from collections import OrderedDict
+
+from jinja2 import Environment
+
+from lib.models import ScheduleSlot
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+RENDER_CACHE_SIZE = 32
+
+SLOT_FIELDS = ("uuid", "template_uuid", "foreground_image_uuid", "display_text", "time_format", "start_time",
+               "weekday")
+EVENT_FIELDS = ("uuid", "foreground_image_uuid", "display_text", "event_start", "event_end", "override")
+
+
+def render_fingerprint(slot: ScheduleSlot, events) -> tuple:
+    """ Everything about the slot and its active events that can affect the rendered page """
+    return (tuple(getattr(slot, f) for f in SLOT_FIELDS),
+            tuple(tuple(getattr(e, f) for f in EVENT_FIELDS) for e in events))
+
+
+class RenderCache(object):
+    """ Memoizes renders of user templates, keyed by template uuid, a hash of the template's source and a fingerprint of
+    the slot and events. The environment should have auto_reload off, so templates aren't stat'ed on every render;
+    instead evict() is called when sync replaces a template file """
+
+    def __init__(self, env: Environment, templates_folder: str, size=RENDER_CACHE_SIZE):
+        self.env = env
+        self.templates_folder = templates_folder
+        self.size = size
+        self.renders = OrderedDict()  # LRU of key -> html
+        self.template_hashes = {}  # template uuid -> sha256 of its source
+        self.lock = threading.Lock()  # evict() is called from the redis listener thread
+        self.hits = 0
+        self.misses = 0
+
+    def template_hash(self, template_uuid) -> str:
+        if template_uuid not in self.template_hashes:
+            with open(os.path.join(self.templates_folder, template_uuid), 'rb') as f:
+                self.template_hashes[template_uuid] = hashlib.sha256(f.read()).hexdigest()
+        return self.template_hashes[template_uuid]
+
+    def render(self, slot: ScheduleSlot, events) -> str:
+        with self.lock:
+            key = (slot.template_uuid, self.template_hash(slot.template_uuid), render_fingerprint(slot, events))
+            if key in self.renders:
+                self.hits += 1
+                self.renders.move_to_end(key)
+                return self.renders[key]
+            self.misses += 1
+            html = self.env.get_template(slot.template_uuid).render(slot=slot, events=events)
+            self.renders[key] = html
+            if len(self.renders) > self.size:
+                self.renders.popitem(last=False)
+            return html
+
+    def evict(self, template_uuid):
+        """ Forget everything about a template whose file has been replaced """
+        if isinstance(template_uuid, bytes):
+            template_uuid = template_uuid.decode('utf-8')
+        logging.debug(f"Evicting template {template_uuid} from render cache")
+        with self.lock:
+            self.template_hashes.pop(template_uuid, None)
+            self.renders = OrderedDict((k, v) for k, v in self.renders.items() if k[0] != template_uuid)
+            # Templates can import each other (e.g. macros.html), so drop all compiled templates rather than just this one
+            self.env.cache.clear()
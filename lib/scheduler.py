@@ -1,34 +1,161 @@
+import bisect
+import heapq
 import logging.config
 from datetime import datetime, timedelta
-from typing import List
+from time import monotonic
+from typing import Dict, Iterable, List, Optional
 
+import redis
+
+from lib import change_feed
 from lib.models import ScheduleSlot, Event, Session
 from lib.utils import WEEKDAY_DICT, get_db_mtime
 
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
 
+# Comparisons against slot/event times are strict, so wake slightly after a boundary rather than exactly on it
+TRANSITION_MARGIN = timedelta(milliseconds=50)
+# While redis is down, try the change feed again after this long, doubling after each failure up to the maximum
+FEED_RETRY_DELAY = 5  # secs
+MAX_FEED_RETRY_DELAY = 300  # secs
+
+
+def slot_sort_key(slot: ScheduleSlot):
+    return WEEKDAY_DICT[slot.weekday], slot.start_time
+
+
+def next_occurrence(slot: ScheduleSlot, after: datetime) -> datetime:
+    """ The first time strictly after `after` that the weekly slot starts """
+    days_ahead = (WEEKDAY_DICT[slot.weekday] - after.weekday()) % 7
+    start = datetime.combine(after.date() + timedelta(days_ahead), slot.start_time)
+    if start <= after:
+        start += timedelta(weeks=1)
+    return start
+
+
+class EventIndex(object):
+    """ Keeps track of which events are active as time moves forward, without rescanning every event.
+
+    Events that haven't started yet sit in a min-heap ordered by start, and events that have started sit in a
+    min-heap ordered by end. Advancing the clock pops whatever has crossed a boundary, so each event costs O(log n)
+    when it starts and again when it ends, and the next boundary is always at the top of one of the heaps.
+    Updated or removed events are left in the heaps and skipped when they reach the top. """
+
+    def __init__(self, events: Iterable[Event] = ()):
+        self.events: Dict[str, Event] = {}
+        self.versions: Dict[str, int] = {}  # Bumped on every change, so stale heap entries can be recognised
+        self.active: Dict[str, Event] = {}
+        self.pending_starts = []  # Heap of (event_start, uuid, version)
+        self.pending_ends = []  # Heap of (event_end, uuid, version)
+        self.now: Optional[datetime] = None
+        self.rebuild(events)
+
+    def __len__(self):
+        return len(self.events)
+
+    def rebuild(self, events: Iterable[Event] = None):
+        """ Re-index from scratch. Only needed on a full reload, or if the clock goes backwards """
+        if events is not None:
+            self.events = {e.uuid: e for e in events}
+        self.versions = {uuid: self.versions.get(uuid, 0) for uuid in self.events}
+        self.active = {}
+        self.pending_starts = [(e.event_start, e.uuid, self.versions[e.uuid]) for e in self.events.values()]
+        self.pending_ends = []
+        heapq.heapify(self.pending_starts)
+        now, self.now = self.now, None
+        if now:
+            self.advance(now)
+
+    def add(self, event: Event):
+        """ Add an event, or replace the existing event with the same uuid """
+        self.versions[event.uuid] = self.versions.get(event.uuid, 0) + 1
+        self.active.pop(event.uuid, None)
+        self.events[event.uuid] = event
+        heapq.heappush(self.pending_starts, (event.event_start, event.uuid, self.versions[event.uuid]))
+        if self.now:
+            self.advance(self.now)
+        self._compact()
+
+    def remove(self, uuid: str):
+        if uuid not in self.events:
+            return
+        del self.events[uuid]
+        self.versions[uuid] += 1
+        self.active.pop(uuid, None)
+        self._compact()
+
+    def advance(self, now: datetime):
+        """ Move the index forward to now, updating the set of active events """
+        if self.now and now < self.now:
+            logging.info("Clock went backwards, rebuilding event index")
+            self.now = now
+            self.rebuild()
+            return
+        self.now = now
+        while self.pending_starts and self.pending_starts[0][0] < now:
+            _, uuid, version = heapq.heappop(self.pending_starts)
+            if self.versions.get(uuid) != version or uuid not in self.events:
+                continue
+            event = self.events[uuid]
+            if event.event_end > now:
+                self.active[uuid] = event
+                heapq.heappush(self.pending_ends, (event.event_end, uuid, version))
+        while self.pending_ends and self.pending_ends[0][0] <= now:
+            _, uuid, version = heapq.heappop(self.pending_ends)
+            if self.versions.get(uuid) == version:
+                self.active.pop(uuid, None)
+
+    def active_events(self) -> List[Event]:
+        return sorted(self.active.values(), key=lambda e: (e.event_start, e.uuid))
+
+    def active_at(self, when: datetime) -> List[Event]:
+        """ The events that will be active at a future time, in the same order as active_events(). Scans every event,
+        so only for occasional use """
+        return sorted((e for e in self.events.values() if e.event_start < when < e.event_end),
+                      key=lambda e: (e.event_start, e.uuid))
+
+    def next_boundary(self) -> Optional[datetime]:
+        """ The next time an event starts or ends, after the time the index was last advanced to """
+        self._discard_stale(self.pending_starts)
+        self._discard_stale(self.pending_ends)
+        boundaries = [heap[0][0] for heap in (self.pending_starts, self.pending_ends) if heap]
+        return min(boundaries, default=None)
+
+    def _discard_stale(self, heap):
+        while heap and (heap[0][1] not in self.events or self.versions[heap[0][1]] != heap[0][2]):
+            heapq.heappop(heap)
+
+    def _compact(self):
+        # Stop the heaps filling up with stale entries when the same events are edited over and over
+        if len(self.pending_starts) + len(self.pending_ends) > 2 * len(self.events) + 64:
+            self.rebuild()
+
+
 class Scheduler(object):
     def __init__(self):
         self.refresh_needed = True
         self.last_update_db_mtime = None
+        self.change_position = None  # (stream id, seq) of the last change feed record applied
+        self.feed_retry_at = None  # When to try the change feed again, while it can't be read
+        self.feed_retry_delay = FEED_RETRY_DELAY
         self.slots: List[ScheduleSlot] = []
         self.current_slot = None
         self.current_slot_index = None
         self.next_slot = None
-        self.events: List[Event] = []
+        self.next_slot_start = None  # When the next slot takes over from the current one
+        self.event_index = EventIndex()
         self.event_active = False
         self.active_events: List[Event] = []
-        self.daily_events: List[Event] = []
-        self.daily_events_date = None  # To check if events have been collected today
         self.update_assets_from_db()
         self.calculate_current_slot()
-        self.calculate_daily_events()
         self.calculate_current_events()
 
-    def set_current_slot(self, slot):
+    def set_current_slot(self, slot, started_at: datetime = None):
         if not slot:
             logging.debug(f"SlotHandler: No slot found")
             self.current_slot = None
+            self.next_slot = None
+            self.next_slot_start = None
             return
         logging.debug(f"Setting current slot to {slot.uuid}")
         self.current_slot = slot
@@ -38,6 +165,7 @@ class Scheduler(object):
             self.next_slot = self.slots[0]
         else:
             self.next_slot = self.slots[self.current_slot_index + 1]
+        self.next_slot_start = next_occurrence(self.next_slot, after=started_at or datetime.now())
 
     def sort_slots(self):
         """ Order the list of slots chronologically"""
@@ -46,42 +174,43 @@ class Scheduler(object):
 
     def tick(self):
         """ Check if it's time for the next slot in the order, and switch if so"""
+        now = datetime.now()
         if not self.next_slot:
             logging.warning("No next slot set")
-        elif WEEKDAY_DICT[self.next_slot.weekday] == datetime.now().weekday() and \
-                datetime.now().time() > self.next_slot.start_time:
-            self.set_current_slot(self.next_slot)
-            self.refresh_needed = True
-
-        if self.daily_events_date != datetime.now().date():
-            self.calculate_daily_events()
+        else:
+            # Loop in case we've slept through more than one slot start
+            while now >= self.next_slot_start:
+                self.set_current_slot(self.next_slot, started_at=self.next_slot_start)
+                self.refresh_needed = True
 
         self.calculate_current_events()
 
+    def next_transition(self) -> datetime:
+        """ The next instant at which tick() could change anything: a slot start or an event starting or ending.
+        Never later than midnight, as a daily re-check """
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(1), datetime.min.time())
+        candidates = [t for t in (self.next_slot_start, self.event_index.next_boundary()) if t is not None]
+        return min(candidates + [midnight]) + TRANSITION_MARGIN
+
     def calculate_current_slot(self):
-        """ Return the slot that should currently be active according to times """
-        this_weekday = datetime.now().strftime("%A")
-        current_time = datetime.now().time()
-        days_slots = list(filter(lambda s: s.weekday == this_weekday, self.slots))  # Get today's slots
-        eligible_slots = list(filter(lambda s: s.start_time < current_time, days_slots))  # Filter out future slots
-        if len(eligible_slots) == 0:
+        """ Set the current slot to whichever slot started most recently, going back as far as a week """
+        if len(self.slots) == 0:
             logging.warning("Could not find slot for this time")
-        else:
-            self.set_current_slot(max(eligible_slots, key=lambda s: s.start_time))
-
-    def calculate_daily_events(self):
-        """ Get events that will occur today (to avoid sorting through all events every tick) """
-        today = datetime.now()
-        # Add a couple hours buffer either way, it wont hurt and it will stop unexpected dst shenanigans
-        day_start = datetime(year=today.year, month=today.month, day=today.day) - timedelta(2)
-        day_end = datetime(year=today.year, month=today.month, day=today.day, hour=23) + timedelta(3)
-        self.daily_events = [e for e in self.events
-                             if (e.event_start < day_start > e.event_end)  # Starts before day, ends during/after day
-                             or (day_start < e.event_start < day_end)]  # Starts during day
-        self.daily_events_date = today.date()
+            self.set_current_slot(None)
+            return
+        now = datetime.now()
+        week = timedelta(weeks=1)
+        slot = max(self.slots, key=lambda s: next_occurrence(s, after=now) - week)
+        self.set_current_slot(slot, started_at=next_occurrence(slot, after=now) - week)
 
     def calculate_current_events(self):
-        self.active_events = [e for e in self.daily_events if e.event_start < datetime.now() < e.event_end]
+        self.event_index.advance(datetime.now())
+        active_events = self.event_index.active_events()
+        if active_events != self.active_events:
+            # An event has started or finished, so the screen needs redrawing
+            self.active_events = active_events
+            self.refresh_needed = True
         if len(self.active_events) > 0:
             self.event_active = True
         else:
@@ -91,20 +220,101 @@ class Scheduler(object):
         """ Load the slots from the database into the scheduler """
         logging.debug("Loading assets into slot handler")
         self.last_update_db_mtime = get_db_mtime()
+        try:
+            self.change_position = change_feed.latest_position()
+            self.feed_retry_at = None
+        except redis.exceptions.ConnectionError:
+            self.lost_change_feed()
         session = Session()
         new_slots = session.query(ScheduleSlot).all()
         new_events = session.query(Event).all()
         session.close()
-        if new_slots == self.slots and new_events == self.events:
+        now = datetime.now()
+        new_events = [e for e in new_events if e.event_end > now]
+        if new_slots == self.slots and new_events == list(self.event_index.events.values()):
             # If nothing changed, do nothing
             logging.debug("No change in assets")
             return
         self.slots = new_slots
         self.sort_slots()
         self.calculate_current_slot()
-        for e in new_events:
-            if e.event_end < datetime.now():
-                new_events.remove(e)
-        self.events = new_events
-        self.calculate_daily_events()
+        self.event_index.rebuild(new_events)
         self.refresh_needed = True
+
+    def lost_change_feed(self):
+        """ Stop using the change feed until it can be read again. Until then, apply_changes checks the database
+        modification time, and tries the feed again less and less often """
+        if self.feed_retry_at is None:
+            logging.warning("Could not read schedule change feed, checking database modification time instead")
+            self.feed_retry_delay = FEED_RETRY_DELAY
+        else:
+            logging.debug("Schedule change feed still unavailable")
+            self.feed_retry_delay = min(self.feed_retry_delay * 2, MAX_FEED_RETRY_DELAY)
+        self.change_position = None
+        self.feed_retry_at = monotonic() + self.feed_retry_delay
+
+    def change_feed_available(self) -> bool:
+        try:
+            change_feed.latest_position()
+            return True
+        except redis.exceptions.ConnectionError:
+            self.lost_change_feed()
+            return False
+
+    def apply_changes(self):
+        """ Apply the changes published to the change feed since we last looked, one slot or event at a time.
+        Falls back to reloading everything if the feed has a gap or can't be read """
+        if self.change_position is None:
+            if monotonic() >= self.feed_retry_at and self.change_feed_available():
+                # Changes made while it was unavailable may not be in the feed, so start again from the database
+                logging.info("Schedule change feed available again, reloading the schedule")
+                self.update_assets_from_db()
+            elif get_db_mtime() > self.last_update_db_mtime:
+                self.update_assets_from_db()
+            return
+        try:
+            changes = change_feed.changes_since(self.change_position)
+        except redis.exceptions.ConnectionError:
+            self.lost_change_feed()
+            if get_db_mtime() > self.last_update_db_mtime:
+                self.update_assets_from_db()
+            return
+        if changes is None or any(c.op == change_feed.RELOAD for c in changes):
+            self.update_assets_from_db()
+            return
+        if not changes:
+            return
+        logging.debug(f"Applying {len(changes)} schedule changes")
+        self.change_position = (changes[-1].id, changes[-1].seq)
+        self.last_update_db_mtime = get_db_mtime()
+
+        # Only the latest operation on each entity matters
+        latest = {(c.entity, c.uuid): c.op for c in changes}
+        upserts = {entity: [uuid for (e, uuid), op in latest.items() if e == entity and op == change_feed.UPSERT]
+                   for entity in (change_feed.SCHEDULE_SLOT, change_feed.EVENT)}
+        with Session() as session:
+            new_slots = session.query(ScheduleSlot).filter(
+                ScheduleSlot.uuid.in_(upserts[change_feed.SCHEDULE_SLOT])).all()
+            new_events = session.query(Event).filter(Event.uuid.in_(upserts[change_feed.EVENT])).all()
+
+        changed_slot_uuids = {uuid for entity, uuid in latest if entity == change_feed.SCHEDULE_SLOT}
+        if changed_slot_uuids:
+            self.slots = [s for s in self.slots if s.uuid not in changed_slot_uuids]
+            for slot in new_slots:
+                keys = [slot_sort_key(s) for s in self.slots]
+                self.slots.insert(bisect.bisect_right(keys, slot_sort_key(slot)), slot)
+            previous_slot = self.current_slot
+            self.calculate_current_slot()
+            if self.current_slot is not previous_slot:
+                self.refresh_needed = True
+
+        for (entity, uuid), op in latest.items():
+            if entity == change_feed.EVENT and op == change_feed.DELETE:
+                self.event_index.remove(uuid)
+        now = datetime.now()
+        for event in new_events:
+            if event.event_end > now:
+                self.event_index.add(event)
+            else:
+                self.event_index.remove(event.uuid)
+        self.calculate_current_events()
@@ -0,0 +1,152 @@
+import json
+import logging.config
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional
+
+import redis
+
+from lib.utils import connect_to_redis, wait_for_redis
+
+logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
+
+# Device state lives in plain redis keys, as before, so anything can still read it with a GET. Writers go through
+# publish_state, which also announces the change on STATE_CHANNEL, so readers can block until the state they're waiting
+# for arrives instead of polling the keys in a loop.
+STATE_CHANNEL = "device-state"  # network/wifi_manager.py can't import lib, so has its own copy
+SAFETY_POLL = 30  # secs. Re-read the keys at least this often, in case a change was missed
+RETRY_DELAY = 1  # secs
+
+# State keys. Flags are stored as bits, everything else as strings
+INTERNET_CONNECTED = "internet-connected"
+WIFI_MANAGER_CONNECTING = "wifi-manager-connecting"
+WIFI_CONNECT_STATUS = "wifi-connect-status"  # starting, user-on-portal, connecting, user-error or success
+STARTUP_SYNC_COMPLETED = "startup-sync-completed"
+FLAGS = {INTERNET_CONNECTED, WIFI_MANAGER_CONNECTING}
+
+
+class StateChange(NamedTuple):
+    key: str
+    value: Any
+
+
+def publish_state(key: str, value, ex=None, r=None):
+    """ Set a state key and announce the change. Booleans are stored as bits """
+    r = r or connect_to_redis()
+    with r.pipeline(transaction=False) as pipe:
+        if isinstance(value, bool):
+            pipe.setbit(key, offset=0, value=int(value))
+        else:
+            pipe.set(key, value, ex=ex)
+        pipe.publish(STATE_CHANNEL, json.dumps({"key": key, "value": value}))
+        pipe.execute()
+
+
+def read_state(keys: Iterable[str], r=None) -> Dict[str, Any]:
+    """ Current values of keys in one round trip. Flags are bools, other keys strings, or None if not set """
+    keys = list(keys)
+    r = r or connect_to_redis()
+    with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            if key in FLAGS:
+                pipe.getbit(key, 0)
+            else:
+                pipe.get(key)
+        values = pipe.execute()
+    return {key: bool(value) if key in FLAGS else value.decode('utf-8') if value is not None else None
+            for key, value in zip(keys, values)}
+
+
+class StateSubscription(object):
+    """ Reads state keys and waits for them to change. Subscribes before the first read, so a change published in
+    between is never missed:
+
+        with StateSubscription([WIFI_CONNECT_STATUS]) as subscription:
+            while subscription.read()[WIFI_CONNECT_STATUS] != "success":
+                subscription.wait(60)
+    """
+
+    def __init__(self, keys: Iterable[str]):
+        self.keys = list(keys)
+        self.r = connect_to_redis()
+        self.pubsub = None
+
+    def __enter__(self):
+        self.subscribe()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def subscribe(self):
+        self.pubsub = self.r.pubsub()
+        self.pubsub.subscribe(STATE_CHANNEL)
+        # Wait for the confirmation, so later changes are definitely delivered
+        self.pubsub.get_message(timeout=RETRY_DELAY)
+
+    def close(self):
+        if self.pubsub is not None:
+            self.pubsub.close()
+            self.pubsub = None
+
+    def read(self) -> Dict[str, Any]:
+        return read_state(self.keys, self.r)
+
+    def wait(self, timeout: float) -> Optional[StateChange]:
+        """ Block until a state change is published, for up to timeout secs. Returns the change, or None if there
+        wasn't one. Changes to other keys are returned too, so callers should read() rather than trust the value """
+        deadline = monotonic() + timeout
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                if self.pubsub is None:
+                    self.subscribe()
+                message = self.pubsub.get_message(timeout=remaining)
+            except redis.exceptions.ConnectionError:
+                logging.warning("Lost redis subscription to device state, retrying")
+                self.close()
+                sleep(min(RETRY_DELAY, remaining))
+                # Anything could have changed while disconnected
+                return StateChange(key=None, value=None)
+            if message is None or message["type"] != "message":
+                continue
+            try:
+                change = json.loads(message["data"])
+                return StateChange(key=change["key"], value=change["value"])
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f"Ignoring malformed device state message {message['data']}")
+
+
+def wait_for_state(keys: Iterable[str], condition: Callable[[Dict[str, Any]], bool],
+                   timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """ Block until condition(state) is true for the values of keys, or timeout secs have passed (never, if None).
+    Returns the state that satisfied condition, or None on timeout """
+    deadline = None if timeout is None else monotonic() + timeout
+    with StateSubscription(keys) as subscription:
+        while True:
+            state = subscription.read()
+            if condition(state):
+                return state
+            remaining = SAFETY_POLL if deadline is None else deadline - monotonic()
+            if remaining <= 0:
+                return None
+            subscription.wait(min(remaining, SAFETY_POLL))
+
+
+def wait_for_wifi_manager(timeout=5) -> bool:
+    """ Wait until wifi_manager has either found a connection or started setting one up """
+    logging.info("Waiting for wifi_manager to startup")
+    wait_for_redis(200, 0.1)
+    if wait_for_state([INTERNET_CONNECTED, WIFI_MANAGER_CONNECTING],
+                      lambda s: s[INTERNET_CONNECTED] or s[WIFI_MANAGER_CONNECTING], timeout):
+        return True
+    logging.error("Failed to get wifi-status")
+    return False
+
+
+def wait_for_startup_sync(timeout=500) -> bool:
+    if wait_for_state([STARTUP_SYNC_COMPLETED], lambda s: s[STARTUP_SYNC_COMPLETED] is not None, timeout):
+        return True
+    logging.error("Failed to wait for startup sync")
+    return False
@@ -1,79 +1,125 @@
 import os
 import logging.config
 from datetime import timedelta
-from random import randrange
+from functools import partial
+from typing import List
 from urllib.parse import urlencode, urljoin
 
-import requests
-from celery.schedules import crontab
-from celery import Celery
-
+from lib import metrics
+from lib.asset_store import IMAGE, TEMPLATE, asset_paths, enforce_quota, ingest, record_stats, referenced_assets, \
+    touch
 from lib.authentication import get_auth_header
-from lib.db_helper import create_or_update_schedule_slot, create_or_update_event
-from lib.models import Session
-from lib.utils import kenban_server_request, connect_to_redis
+from lib.db_helper import sync_all_schedule_slots, sync_all_events, get_asset_manifest, record_downloaded_assets
+from lib.downloads import download_file, download_files, remove_stale_parts, file_sha256
+from lib.http_client import pool_stats
+from lib.jobs import CronSchedule, Job
+from lib.image_derivatives import publish_image, publish_images, remove_unused_derivatives
+from lib.models import Session, Asset
+from lib.utils import kenban_server_request, connect_to_redis, wake_display, TEMPLATE_UPDATED_CHANNEL
 from settings import settings
 
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
 
-HOME = os.getenv('HOME', '/home/user')
-CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
-CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
-CELERY_TASK_RESULT_EXPIRES = timedelta(hours=6)
 
-celery = Celery(
-    "websocket",
-    backend=CELERY_RESULT_BACKEND,
-    broker=CELERY_BROKER_URL,
-    result_expires=CELERY_TASK_RESULT_EXPIRES
-)
+def timed_step(step: str):
+    """ Decorator recording how long a sync step takes """
+    return metrics.timed(metrics.histogram("kenban_sync_seconds", "Time taken by each step of syncing with the server",
+                                           buckets=metrics.SLOW_BUCKETS, step=step))
+
+
+def record_failure(step: str):
+    metrics.counter("kenban_sync_failures_total", "Sync steps that couldn't get data from the server",
+                    step=step).inc()
+
+
+last_pool_stats = {"hits": 0, "misses": 0}  # pool_stats() as of the last record_pool_stats()
+
 
+def record_pool_stats():
+    """ Add the requests that reused a pooled connection, or had to open one, since the last call to counters """
+    stats = pool_stats()
+    for result, key in (("hit", "hits"), ("miss", "misses")):
+        # The counts start from 0 again when the session is recreated after a fork or a pool is dropped
+        new = stats[key] - last_pool_stats[key] if stats[key] >= last_pool_stats[key] else stats[key]
+        metrics.counter("kenban_http_pool_requests_total",
+                        "Requests that reused a pooled connection (hit) or opened one (miss)", result=result).inc(new)
+        last_pool_stats[key] = stats[key]
 
-@celery.on_after_configure.connect
-def setup_periodic_tasks(sender, **kwargs):
-    # Do a weekly re-download of everything
-    sender.add_periodic_task(crontab(day_of_week=randrange(0, 7),
-                                     hour=randrange(0, 24),
-                                     minute=randrange(0, 60),
-                                     ), full_sync.s(overwrite=True), )
 
+def scheduled_jobs() -> List[Job]:
+    return [
+        Job("full_sync", full_sync),
+        # Do a weekly check of everything. Unchanged files aren't re-downloaded, and corrupted files are replaced.
+        # Each device picks its own time in the week, so they don't all hit the server together
+        Job("weekly_full_sync", partial(full_sync, overwrite=True),
+            CronSchedule(minute=0, hour=0, day_of_week=0, jitter=timedelta(weeks=1),
+                         seed=f"{settings['device_uuid']}:weekly_full_sync")),
+    ]
 
-@celery.task
-def full_sync(overwrite=False):
+
+@timed_step("full_sync")
+def full_sync(overwrite=False, last_update=None):
     logging.info("Performing full sync with kenban server")
+    if last_update is None:
+        # Read before syncing, so that anything edited during the sync is picked up by the next one
+        last_update = get_server_last_update_time()
     sync_images(overwrite=overwrite)
     sync_templates(overwrite=overwrite)
-    sync_schedule_slots()
-    sync_events()
-    settings["last_update"] = get_server_last_update_time()  # May save error message from the server. This is ok
-    settings.save()
+    synced = sync_schedule_slots()
+    synced = sync_events() and synced
+    fetch_missing_assets()
+    enforce_quota()
+    record_pool_stats()
+    if synced:
+        # Lets the next startup skip syncing if nothing changes in the meantime, so only saved if the sync worked
+        settings["last_update"] = last_update  # May save error message from the server. This is ok
+        settings.save()
     r = connect_to_redis()
     r.set("refresh-browser", 1)
+    wake_display("full sync")
+
+
+@timed_step("startup_sync")
+def startup_sync() -> bool:
+    """ Sync after a reboot, unless nothing has changed on the server since the last sync. Returns True if it synced """
+    last_update = get_server_last_update_time()
+    if last_update is not None and str(last_update) == str(settings["last_update"]):
+        logging.info(f"Schedule unchanged since the last sync at {last_update}, skipping startup sync")
+        # Cheap if everything is there. Covers files lost since, e.g. to a full SD card
+        fetch_missing_assets()
+        return False
+    full_sync(last_update=last_update)
+    return True
 
 
+@timed_step("sync_schedule_slots")
 def sync_schedule_slots():
     """Get all of the user's schedule slots from the Kenban server and save them to local database"""
     url = settings['server_address'] + settings['schedule_url'] + settings["device_uuid"]
     schedule_slots = kenban_server_request(url=url, method='GET', headers=get_auth_header())
-    if not schedule_slots:
+    if schedule_slots is None:
+        record_failure("sync_schedule_slots")
         return None
     with Session() as session:
-        for slot in schedule_slots:
-            create_or_update_schedule_slot(session, slot)
+        sync_all_schedule_slots(session, schedule_slots)
         session.commit()
+    return True
 
 
+@timed_step("sync_events")
 def sync_events():
     url = settings['server_address'] + settings['event_url'] + settings["device_uuid"]
     events = kenban_server_request(url=url, method='GET', headers=get_auth_header())
-    if not events:
+    if events is None:
+        record_failure("sync_events")
         return None
     with Session() as session:
-        for event in events:
-            create_or_update_event(session, event)
+        sync_all_events(session, events)
         session.commit()
+    return True
 
 
+@timed_step("sync_images")
 def sync_images(overwrite=False):
     image_params = {
         'thumbnail': 'false',
@@ -91,49 +137,88 @@ def sync_images(overwrite=False):
 
     images = kenban_server_request(url=url, method='GET', headers=get_auth_header())
     if not images:
+        record_failure("sync_images")
         return None
-    if not os.path.exists(settings["images_folder"]):
-        os.makedirs(settings["images_folder"])
-    existing_file_uuids = os.listdir(settings["images_folder"])
+    for folder in (settings["original_images_folder"], settings["images_folder"]):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    remove_stale_parts(settings["original_images_folder"])
+    # Images downloaded before originals were kept separately are only in images_folder
+    existing_file_uuids = set(os.listdir(settings["original_images_folder"]) + os.listdir(settings["images_folder"]))
     logging.debug("Existing images: " + str(existing_file_uuids))
+    manifest = get_asset_manifest(IMAGE)
+    # Evicted images are only fetched again if the schedule needs them, by fetch_missing_assets()
+    images = [i for i in images if not (i["uuid"] in manifest and manifest[i["uuid"]].evicted)]
+    uuids, to_download = [], []
     for image in images:
         if image['uuid'] in existing_file_uuids and not overwrite:
             logging.debug("Already got image " + image['uuid'])
             continue
-        img_data = requests.get(image["src"]).content
-        fp = settings["images_folder"] + image["uuid"]
-        with open(fp, 'wb') as output_file:
-            output_file.write(img_data)
-            logging.info("Saving Image " + image["uuid"])
+        fp = settings["original_images_folder"] + image["uuid"]
+        uuids.append(image["uuid"])
+        to_download.append((image["src"], fp, conditional_headers(fp, manifest.get(image["uuid"]))))
+    stats = download_files(to_download) if to_download else None
+    if stats:
+        for uuid, result in zip(uuids, stats.results):
+            ingest(IMAGE, uuid, result)
+        record_downloaded_assets(IMAGE, list(zip(uuids, stats.results)))
+        logging.info(f"Image sync: {stats.summary()}")
+        manifest = get_asset_manifest(IMAGE)
+    unchanged = len(stats.unchanged) if stats else 0
+    record_stats(hits=len(images) - len(to_download) + unchanged, misses=len(to_download) - unchanged)
+    # Also re-publishes images that didn't need downloading, in case the resolution setting has changed
+    publish_images([(image["uuid"], manifest[image["uuid"]].sha256 if image["uuid"] in manifest else None)
+                    for image in images])
+    remove_unused_derivatives()
+    return stats
 
 
+@timed_step("sync_templates")
 def sync_templates(overwrite=False):
     url = settings['server_address'] + settings['template_info_url']
     db_templates = kenban_server_request(url=url, method='GET', headers=get_auth_header())
     if not db_templates:
         logging.error(f"Failed to get templates from server at {url}")
+        record_failure("sync_templates")
         return None
     if not os.path.exists(settings["templates_folder"]):
         os.makedirs(settings["templates_folder"])
+    remove_stale_parts(settings["templates_folder"])
     existing_template_uuids = os.listdir(settings["templates_folder"])
     logging.debug("Existing templates: " + str(existing_template_uuids))
+    manifest = get_asset_manifest(TEMPLATE)
+    hits = 0
     for template in db_templates:
+        entry = manifest.get(template["uuid"])
+        if entry and entry.evicted:
+            continue
         if template["uuid"] not in existing_template_uuids or overwrite:
-            get_template(template["uuid"])
+            result = get_template(template["uuid"], entry)
+            hits += bool(result and result.not_modified)
+        else:
+            hits += 1
+    record_stats(hits=hits)
+
 
-            
-def get_template(template_uuid):
+def get_template(template_uuid, manifest_entry: Asset = None):
+    """ Download a template. With a manifest entry, only download it if it has changed or is corrupt """
     url = settings["server_address"] + settings["template_raw_url"] + template_uuid
-    template = kenban_server_request(url=url, method='GET', headers=get_auth_header(), decode_json=False)
-    if not template:
+    fp = settings["templates_folder"] + template_uuid
+    headers = {**get_auth_header(), **conditional_headers(fp, manifest_entry)}
+    result = download_file(url, fp, headers=headers)
+    if not result.ok:
         logging.error(f"Failed to get template {template_uuid} from server at {url}")
         return None
-    if not os.path.exists(settings["templates_folder"]):
-        os.makedirs(settings["templates_folder"])
-    fp = settings["templates_folder"] + template_uuid
-    with open(fp, 'wb') as output_file:
-        output_file.write(template)
-        logging.info("Saved template " + template_uuid)
+    if result.not_modified:
+        logging.debug(f"Template {template_uuid} unchanged")
+        return result
+    ingest(TEMPLATE, template_uuid, result)
+    record_downloaded_assets(TEMPLATE, [(template_uuid, result)])
+    record_stats(misses=1)
+    # Let the viewer drop its compiled and rendered copies of the old template
+    connect_to_redis().publish(TEMPLATE_UPDATED_CHANNEL, template_uuid)
+    logging.info("Saved template " + template_uuid)
+    return result
 
 
 def get_image(image_uuid):
@@ -141,13 +226,37 @@ def get_image(image_uuid):
         return None
     kenban_url = settings['server_address'] + settings['image_url'] + image_uuid
     image = kenban_server_request(url=kenban_url, method='GET', headers=get_auth_header())
-    img_data = requests.get(image["src"]).content
-    if not img_data:
+    if not image:
+        return None
+    result = download_file(image["src"], settings["original_images_folder"] + image_uuid)
+    if not result.ok:
         return None
-    fp = settings["images_folder"] + image_uuid
-    with open(fp, 'wb') as output_file:
-        output_file.write(img_data)
-        logging.info("Saving Image " + image_uuid)
+    ingest(IMAGE, image_uuid, result)
+    record_downloaded_assets(IMAGE, [(image_uuid, result)])
+    record_stats(misses=1)
+    publish_image(image_uuid, result.sha256)
+    logging.info(f"Saved image {image_uuid}: {result.size} bytes in {result.seconds:.1f}s "
+                 f"({result.throughput / 1e3:.0f} KB/s)")
+    return result
+
+
+def conditional_headers(fp, manifest_entry: Asset = None) -> dict:
+    """ Headers asking the server to only send the file if it has changed since we downloaded it. Only used if the
+    local copy still matches the manifest, otherwise we want a fresh copy whatever the server thinks """
+    if not manifest_entry or not (manifest_entry.etag or manifest_entry.last_modified):
+        return {}
+    try:
+        if os.path.getsize(fp) != manifest_entry.size or file_sha256(fp) != manifest_entry.sha256:
+            logging.warning(f"{fp} doesn't match the asset manifest, downloading it again")
+            return {}
+    except OSError:
+        return {}
+    headers = {}
+    if manifest_entry.etag:
+        headers["If-None-Match"] = manifest_entry.etag
+    if manifest_entry.last_modified:
+        headers["If-Modified-Since"] = manifest_entry.last_modified
+    return headers
 
 
 def get_server_last_update_time():
@@ -159,11 +268,33 @@ def get_server_last_update_time():
     return server_update_time
 
 
+@timed_step("ensure_images_and_templates")
 def ensure_images_and_templates_in_local_storage(payload):
     existing_image_uuids = os.listdir(settings["images_folder"])
     existing_template_uuids = os.listdir(settings["templates_folder"])
 
     if "foreground_image_uuid" in payload and payload["foreground_image_uuid"] not in existing_image_uuids:
         get_image(payload["foreground_image_uuid"])
+    elif payload.get("foreground_image_uuid"):
+        record_stats(hits=1)
+        touch(IMAGE, [payload["foreground_image_uuid"]])
     if "template_uuid" in payload and payload["template_uuid"] not in existing_template_uuids:
         get_template(payload["template_uuid"])
+    elif payload.get("template_uuid"):
+        record_stats(hits=1)
+        touch(TEMPLATE, [payload["template_uuid"]])
+
+
+@timed_step("fetch_missing_assets")
+def fetch_missing_assets():
+    """ Download anything the schedule needs that isn't stored, e.g. because it was evicted to stay under quota """
+    with Session() as session:
+        referenced = referenced_assets(session)
+    for kind, uuid in referenced:
+        if os.path.exists(asset_paths(kind, uuid)[-1]):
+            continue
+        logging.info(f"Fetching missing {kind} {uuid}")
+        if kind == IMAGE:
+            get_image(uuid)
+        else:
+            get_template(uuid)
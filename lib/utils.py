@@ -4,6 +4,7 @@ import os
 import socket
 import string
 import struct
+import threading
 from datetime import datetime, time
 from distutils.util import strtobool
 from time import sleep
@@ -11,6 +12,7 @@ from time import sleep
 import redis
 import requests
 
+from lib.http_client import http_request
 from settings import settings
 
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
@@ -27,6 +29,11 @@ WEEKDAY_DICT = {
 
 redis_pool = redis.ConnectionPool(host='localhost')
 
+# Published to whenever something the display loop cares about changes (db contents, refresh requests, banner flags)
+DISPLAY_WAKEUP_CHANNEL = "display-wakeup"
+# Published to with the template's uuid whenever a user template file is replaced
+TEMPLATE_UPDATED_CHANNEL = "template-updated"
+
 
 def string_to_bool(s):
     return bool(strtobool(str(s)))
@@ -43,6 +50,35 @@ def connect_to_redis():
     return redis.Redis(connection_pool=redis_pool)
 
 
+def wake_display(reason: str):
+    """ Ask the display loop to re-check its state now, instead of at its next scheduled transition """
+    r = connect_to_redis()
+    try:
+        r.publish(DISPLAY_WAKEUP_CHANNEL, reason)
+    except redis.exceptions.ConnectionError:
+        logging.warning(f"Could not publish display wakeup: {reason}")
+
+
+def start_redis_listener(channel: str, callback, retry_delay=1) -> threading.Thread:
+    """ Call callback(message_data) for every message published to channel, from a daemon thread.
+    Blocks on the socket rather than polling, and resubscribes if the connection to redis drops """
+
+    def listen():
+        while True:
+            try:
+                pubsub = connect_to_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                for message in pubsub.listen():
+                    callback(message["data"])
+            except redis.exceptions.ConnectionError:
+                logging.warning(f"Lost redis subscription to {channel}, retrying")
+                sleep(retry_delay)
+
+    thread = threading.Thread(target=listen, name=f"redis-listener-{channel}", daemon=True)
+    thread.start()
+    return thread
+
+
 def wait_for_redis(retries: int, wt=0.1):
     # Make sure the redis container has started up
     r = connect_to_redis()
@@ -55,12 +91,20 @@ def wait_for_redis(retries: int, wt=0.1):
     logging.error("Failed to wait for redis to start")
 
 
+def seconds_since_boot() -> float:
+    with open("/proc/uptime") as f:
+        return float(f.read().split()[0])
+
+
 def get_db_mtime():
-    # get database file last modification time
-    try:
-        return os.path.getmtime(settings['database'])
-    except (OSError, TypeError):
-        return 0
+    # get database file last modification time. In WAL mode, writes land in the -wal file until a checkpoint
+    mtimes = [0]
+    for fp in (settings['database'], f"{settings['database']}-wal"):
+        try:
+            mtimes.append(os.path.getmtime(fp))
+        except (OSError, TypeError):
+            pass
+    return max(mtimes)
 
 
 def time_parser(t) -> time:
@@ -83,19 +127,6 @@ def time_parser(t) -> time:
         return time(0, 0)
 
 
-def wait_for_wifi_manager(retries=50, wt=0.1) -> bool:
-    logging.info("Waiting for wifi_manager to startup")
-    wait_for_redis(200, 0.1)
-    r = connect_to_redis()
-    for _ in range(0, retries):
-        if r.getbit("internet-connected", 0) or r.getbit("wifi-manager-connecting", 0):
-            return True
-        else:
-            sleep(wt)
-    logging.error("Failed to get wifi-status")
-    return False
-
-
 def wait_for_internet_ping(retries=500, wt=0.1) -> bool:
     """ Attempt to reach 1.1.1.1 before continuing """
     host = socket.gethostbyname("1.1.1.1")
@@ -130,20 +161,10 @@ def force_ntp_update():
     os.system(f"sudo date -s '{date_string}'")
 
 
-def wait_for_startup_sync(retries=5000, wt=0.1):
-    r = connect_to_redis()
-    for _ in range(0, retries):
-        if r.exists("startup-sync-completed"):
-            return True
-        else:
-            sleep(wt)
-    logging.error("Failed to wait for startup sync")
-
-
 def kenban_server_request(url: string, method: string, data=None, headers=None, decode_json=True):
     logging.debug(f"Making {method} request to {url}")
     try:
-        response = requests.request(url=url, method=method, data=data, headers=headers)
+        response = http_request(url=url, method=method, data=data, headers=headers)
         response.raise_for_status()
         logging.debug(f"Response: {response.content}")
     except requests.exceptions.HTTPError:
@@ -152,6 +173,9 @@ def kenban_server_request(url: string, method: string, data=None, headers=None,
     except requests.exceptions.ConnectionError:
         logging.exception(f"Could not connect to authorisation server at {url}")
         return None
+    except requests.exceptions.Timeout:
+        logging.exception(f"Timed out waiting for {url}")
+        return None
     if decode_json:
         try:
             return json.loads(response.content)
@@ -3,21 +3,34 @@ const redis = require('redis')
 
 const server = new WebSocket.Server({ port : 8000 });
 let sockets = []
+// The display handler only publishes the banner when it changes, so remember the latest one to send to pages as
+// they connect (every page load opens a new connection)
+let lastMessage = null
+
+// One redis subscription shared by all connected pages
+let subscriber = redis.createClient("redis://localhost:6379")
+let client = subscriber.duplicate()
+subscriber.connect().then(() => {
+    subscriber.subscribe('banner_message', (message) => {
+        lastMessage = message
+        sockets.forEach(s => s.send(message))
+    })
+})
+// Pick up the current banner if this server restarted after it was published
+client.connect().then(() => client.get('banner-message')).then((message) => {
+    if (lastMessage === null && message !== null) {
+        lastMessage = message
+    }
+})
 
 server.on('connection', function connection(ws) {
     sockets.push(ws);
+    if (lastMessage !== null) {
+        ws.send(lastMessage)
+    }
 
-    // Subscribe to redis when a websocket connects
-    let redisClient = redis.createClient("redis://localhost:6379")
-    redisClient.connect()
-    redisClient.subscribe('banner_message', (message) => {
-        ws.send(message)
-    })
-
-    // Unsubscribe when the websocket closes
     ws.on('close', function close() {
         sockets = sockets.filter(s => s !== ws)
-        redisClient.unsubscribe('banner_message')
     })
 })
 
@@ -1,17 +1,27 @@
 #!/usr/bin/python
+import json
 import logging.config
 import random
 import re
+import select
+import socket
 import subprocess
+from collections import deque
 from datetime import datetime
 from pathlib import Path
-from time import sleep
+from time import sleep, monotonic
+from typing import Optional
 
 import redis
 from netifaces import gateways, interfaces
 
 r = redis.Redis("127.0.0.1", port=6379)
 
+# Must match lib.utils.DISPLAY_WAKEUP_CHANNEL. This script runs from network/, so can't import lib
+DISPLAY_WAKEUP_CHANNEL = "display-wakeup"
+# Must match lib.state_bus.STATE_CHANNEL
+STATE_CHANNEL = "device-state"
+
 logs_path = Path("logs")
 logs_path.mkdir(exist_ok=True)
 logging.config.fileConfig(fname='../logging.ini', disable_existing_loggers=True)
@@ -23,6 +33,32 @@ SUCCESS_MESSAGE = "Internet connectivity established"
 PASSWORD_LENGTH_ERROR = "Password length should be at least"
 FAILED_TO_CONNECT_ERROR = "Connection to access point not activated"
 
+# rtnetlink multicast groups, from linux/rtnetlink.h
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+NETLINK_GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE
+
+DEBOUNCE = 1.5  # secs without netlink events before the connection is re-checked, so a burst is handled once
+MAX_DEBOUNCE = 10  # secs. Re-check anyway if events keep coming, e.g. IPv6 router advertisements
+SAFETY_POLL = 60  # secs. Re-check even without events, in case one was missed
+ONLINE_POLL = 10  # secs. Poll intervals if netlink isn't available
+OFFLINE_POLL = 1
+FLAP_WINDOW = 3600  # secs. Connection changes are counted over this window
+
+
+def set_state(key: str, value):
+    """ Same as lib.state_bus.publish_state: set a state key and announce the change. Booleans are stored as bits """
+    with r.pipeline(transaction=False) as pipe:
+        if isinstance(value, bool):
+            pipe.setbit(key, offset=0, value=int(value))
+        else:
+            pipe.set(key, value)
+        pipe.publish(STATE_CHANNEL, json.dumps({"key": key, "value": value}))
+        pipe.execute()
+
 
 def start_wifi_connect():
     logger.info("Creating hotspot with wifi-connect application")
@@ -34,20 +70,21 @@ def start_wifi_connect():
         if line:
             logger.debug(line)
             if USER_ON_PORTAL_MESSAGE in line:
-                r.set("wifi-connect-status", "user-on-portal")
+                set_state("wifi-connect-status", "user-on-portal")
             if CONNECTING_MESSAGE in line:
-                r.set("wifi-connect-status", "connecting")
+                set_state("wifi-connect-status", "connecting")
                 logger.info("Connecting to Wi-Fi")
             if SUCCESS_MESSAGE in line:
-                r.set("wifi-connect-status", "success")
-                r.setbit("internet-connected", offset=0, value=1)
+                # Connected first, so the viewer never sees success without it
+                set_state("internet-connected", True)
+                set_state("wifi-connect-status", "success")
                 logger.info("Connected")
                 return True
             if PASSWORD_LENGTH_ERROR in line:
-                r.set("wifi-connect-status", "user-error")
+                set_state("wifi-connect-status", "user-error")
                 logger.warning("Incorrect password entered")
             if FAILED_TO_CONNECT_ERROR in line:
-                r.set("wifi-connect-status", "user-error")
+                set_state("wifi-connect-status", "user-error")
                 logger.warning("Failed to connect to Wi-Fi")
     # If we reach this point, wifi-connect has failed. Exit and retry
     exit()
@@ -67,43 +104,102 @@ def wait_for_redis(retries: int, wt=0.1):
 def initial_startup():
     if gateways().get('default'):
         # If there is a default connection, sleep
-        r.setbit("internet-connected", offset=0, value=1)
+        set_state("internet-connected", True)
         logger.info("Connection detected on startup")
         return
 
     elif any(re.compile("wlan*").match(i) for i in interfaces()):
         # Check for a wireless interface and start Wi-Fi connect if so
-        r.setbit("internet-connected", offset=0, value=0)
-        r.setbit("wifi-manager-connecting", offset=0, value=1)
+        set_state("internet-connected", False)
+        set_state("wifi-manager-connecting", True)
         start_wifi_connect()
         logger.info("wifi-connect finished")
-        r.setbit("internet-connected", offset=0, value=1)
-        r.setbit("wifi-manager-connecting", offset=0, value=0)
+        set_state("internet-connected", True)
+        set_state("wifi-manager-connecting", False)
 
     else:
-        r.setbit("internet-connected", offset=0, value=0)
+        set_state("internet-connected", False)
         logger.error("Could not find wireless connection")
         sleep(1)
 
 
+def open_netlink_socket() -> Optional[socket.socket]:
+    """ Subscribe to the kernel's link, address and route change notifications """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.bind((0, NETLINK_GROUPS))
+    except (OSError, AttributeError) as e:
+        logger.warning(f"Can't subscribe to netlink, polling instead: {e}")
+        return None
+    sock.setblocking(False)
+    return sock
+
+
+def drain_netlink(sock: socket.socket):
+    """ Read every queued notification. Only the fact that something changed matters, not what changed """
+    while True:
+        try:
+            sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # ENOBUFS: the queue overflowed and events were lost, which is fine as the connection is re-checked anyway
+            logger.debug(f"Netlink read failed: {e}")
+            return
+
+
+def wait_for_change(sock: Optional[socket.socket], connected: bool) -> Optional[float]:
+    """ Block until the connection may have changed. Returns when the first netlink event arrived, or None if the
+    wait timed out """
+    if sock is None:
+        sleep(ONLINE_POLL if connected else OFFLINE_POLL)
+        return None
+    if not select.select([sock], [], [], SAFETY_POLL)[0]:
+        return None
+    first_event = monotonic()
+    drain_netlink(sock)
+    # Let the burst settle: a link going down takes its addresses and routes with it, one event each
+    while monotonic() - first_event < MAX_DEBOUNCE and select.select([sock], [], [], DEBOUNCE)[0]:
+        drain_netlink(sock)
+    return first_event
+
+
+def set_connected(connected: bool):
+    if not connected:
+        r.set("last-connected", datetime.now().timestamp())
+    set_state("internet-connected", connected)
+    r.publish(DISPLAY_WAKEUP_CHANNEL, "internet reconnected" if connected else "internet disconnected")
+
+
 def monitoring_loop():
-    last_connected = None
+    sock = open_netlink_socket()
+    connected = bool(gateways().get('default'))
+    set_connected(connected)
+    changed_at = monotonic()
+    flaps = deque()
     while True:
-        if gateways().get('default'):
-            r.setbit("internet-connected", offset=0, value=1)
-            if last_connected:
-                logger.info("Internet reconnected")
-                last_connected = None
-            logger.debug("Internet connected. wifi_manager sleeping...")
-            sleep(10)
+        first_event = wait_for_change(sock, connected)
+        if bool(gateways().get('default')) == connected:
             continue
+        connected = not connected
+        set_connected(connected)
+        now = monotonic()
+        if first_event is not None:
+            detection = f"{now - first_event:.1f}s after the first netlink event"
+        elif sock is not None:
+            detection = "by the safety poll"
+        else:
+            detection = "by polling"
+        flaps.append(now)
+        while flaps[0] < now - FLAP_WINDOW:
+            flaps.popleft()
+        message = (f"Internet {'reconnected' if connected else 'disconnected'} after {now - changed_at:.0f}s, "
+                   f"detected {detection}. {len(flaps)} changes in the last {FLAP_WINDOW // 60} minutes")
+        if connected:
+            logger.info(message)
         else:
-            r.setbit("internet-connected", offset=0, value=0)
-            if not last_connected:
-                last_connected = datetime.now()
-                r.set("last-connected", last_connected.timestamp())
-                logger.error("Internet disconnected")
-            sleep(1)
+            logger.error(message)
+        changed_at = now
 
 
 def wait_for_network(retries=10, wt=1):
@@ -117,8 +213,8 @@ def wait_for_network(retries=10, wt=1):
 
 
 if __name__ == "__main__":
-    r.setbit("internet-connected", offset=0, value=0)
-    r.set("wifi-connect-status", "starting")
+    set_state("internet-connected", False)
+    set_state("wifi-connect-status", "starting")
     wait_for_network()
     wait_for_redis(500)
     initial_startup()
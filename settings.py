@@ -1,10 +1,17 @@
 import configparser
+import logging
 import os
+import tempfile
 from collections import UserDict
 from os import path, getenv
+from time import monotonic, sleep
+
+import redis
 
 CONFIG_DIR = '/home/user/data/'
 CONFIG_FILE = 'kenban.conf'
+# Published to after every save, so other processes can wait for changes instead of polling the file
+SETTINGS_CHANGED_CHANNEL = 'settings-changed'
 
 DEFAULTS = {
     'main': {
@@ -31,13 +38,46 @@ DEFAULTS = {
     'folders': {
         'default_templates_folder': '/home/user/data/default_templates/',
         'default_images_folder': '/home/user/data/default_images/',
-        'images_folder': '/home/user/data/user_images/',
+        'images_folder': '/home/user/data/user_images/',  # What templates are shown. See lib/image_derivatives.py
+        'original_images_folder': '/home/user/data/original_images/',
+        'image_derivatives_folder': '/home/user/data/image_derivatives/',
+        'jobs_state': '/home/user/data/jobs.json',  # When each periodic job last ran
+        'display_snapshot': '/home/user/data/display_snapshot.html',  # The last page shown, for a fast boot
+        'blobs_folder': '/home/user/data/blobs/',  # Content of downloaded images and templates, see lib/asset_store.py
         'templates_folder': '/home/user/data/user_templates/',
+        'jinja_cache_folder': '/home/user/data/jinja_cache/',
+        'metrics_folder': '/home/user/data/metrics/',  # Prometheus textfiles, for node_exporter. See lib/metrics.py
         'database': os.path.join(CONFIG_DIR, 'kenban.db'),
     },
     'viewer': {
         'debug_logging': False,
         'resolution': '1920x1080',
+        # Apply new renders of the template already on screen to the page in place, instead of reloading it
+        'dom_patching': True,
+        # Show images resized to the resolution above, rather than as uploaded
+        'image_derivatives': True,
+        # Secs before a slot starts to load it off-screen, so it appears without a loading gap. 0 to turn off
+        'prerender_lead': 10,
+    },
+    'http': {
+        'http_connect_timeout': 5,  # secs
+        'http_read_timeout': 30,  # secs
+        'http_retries': 3,  # Only idempotent requests are retried
+        'http_backoff': 500,  # ms, doubled after each retry, plus jitter
+    },
+    'storage': {
+        # Least recently used images and templates are deleted above this, unless the schedule needs them
+        'asset_quota': 2 * 1024 * 1024 * 1024,  # bytes
+    },
+    'metrics': {
+        'metrics_interval': 15,  # secs between writing metrics out
+    },
+    'database': {
+        # The viewer, websocket and sync processes all share kenban.db. WAL lets the viewer read while they write
+        'sqlite_journal_mode': 'WAL',
+        'sqlite_synchronous': 'NORMAL',
+        'sqlite_busy_timeout': 5000,  # ms
+        'sqlite_mmap_size': 16777216,  # bytes
     },
 }
 
@@ -52,6 +92,7 @@ class KenbanSettings(UserDict):
         UserDict.__init__(self, *args, **kwargs)
         self.home = getenv('HOME')
         self.conf_file = self.get_configfile()
+        self.loaded_stat = None  # Identifies the version of the file currently in memory
 
         if not path.isfile(self.conf_file):
             self.use_defaults()
@@ -78,14 +119,28 @@ class KenbanSettings(UserDict):
         else:
             config.set(section, field, str(self.get(field, default)))
 
-    def load(self):
-        """Loads the latest settings from kenban.conf into memory."""
+    def file_stat(self):
+        try:
+            st = os.stat(self.conf_file)
+        except OSError:
+            return None
+        # Saves replace the file, so the inode changes even if the size and (coarse) mtime don't
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def load(self, force=False) -> bool:
+        """Loads the latest settings from kenban.conf into memory, if the file has changed since it was last loaded.
+        Returns True if it was re-read."""
+        stat = self.file_stat()
+        if not force and stat is not None and stat == self.loaded_stat:
+            return False
         config = configparser.ConfigParser(allow_no_value=True)
         config.read(self.conf_file)
 
         for section, defaults in DEFAULTS.items():
             for field, default in list(defaults.items()):
                 self._get(config, section, field, default)
+        self.loaded_stat = stat
+        return True
 
     def use_defaults(self):
         for defaults in DEFAULTS.items():
@@ -93,15 +148,47 @@ class KenbanSettings(UserDict):
                 self[field] = default
 
     def save(self):
-        # Write new settings to disk.
+        # Write new settings to disk. Written to a temp file and renamed into place, so other processes never read a
+        # half-written file. What's in memory is already what was written, so there's no need to read it back
         config = configparser.ConfigParser()
         for section, defaults in DEFAULTS.items():
             config.add_section(section)
             for field, default in list(defaults.items()):
                 self._set(config, section, field, default)
-        with open(self.conf_file, "w") as f:
+        with tempfile.NamedTemporaryFile("w", dir=path.dirname(self.conf_file), prefix=".kenban.conf.",
+                                         delete=False) as f:
             config.write(f)
-        self.load()
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, self.conf_file)
+        self.loaded_stat = self.file_stat()
+        self.publish_change()
+
+    def publish_change(self):
+        try:
+            redis.Redis(host='localhost').publish(SETTINGS_CHANGED_CHANNEL, self.conf_file)
+        except redis.exceptions.ConnectionError:
+            logging.debug("Could not publish settings change")
+
+    def wait_for_change(self, timeout) -> bool:
+        """Block until another process saves the settings, or until timeout seconds have passed. Returns True if the
+        settings were reloaded."""
+        pubsub = redis.Redis(host='localhost').pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(SETTINGS_CHANGED_CHANNEL)
+            # Subscribed before checking the file, so a save in between isn't missed
+            if self.load():
+                return True
+            deadline = monotonic() + timeout
+            while monotonic() < deadline and not pubsub.get_message(timeout=deadline - monotonic()):
+                pass
+        except redis.exceptions.ConnectionError:
+            logging.warning("Could not subscribe to settings changes, polling instead")
+            sleep(timeout)
+        finally:
+            pubsub.close()
+        return self.load()
 
     def get_configdir(self):
         return path.join(self.home, CONFIG_DIR)
@@ -0,0 +1,64 @@
+""" Compare the cost of working out the active events with EventIndex against a linear scan of every event.
+
+Run from the repository root:  python -m tests.benchmarks.event_index [number of events]
+"""
+import random
+import sys
+from datetime import datetime, timedelta
+from timeit import default_timer as timer
+
+from lib.models import Event
+from lib.scheduler import EventIndex
+
+
+def generate_events(count: int, start: datetime, days=365):
+    """ Events scattered over a year, mostly a few hours long with the odd multi-day one """
+    events = []
+    for i in range(count):
+        event_start = start + timedelta(minutes=random.randrange(days * 24 * 60))
+        length = timedelta(minutes=random.choice([30, 60, 120, 240, 480, 3 * 24 * 60]))
+        events.append(Event(uuid=f"event-{i}", event_start=event_start, event_end=event_start + length))
+    return events
+
+
+def linear_scan_tick(events, now):
+    active = [e for e in events if e.event_start < now < e.event_end]
+    next_boundary = min((t for e in events for t in (e.event_start, e.event_end) if t > now), default=None)
+    return active, next_boundary
+
+
+def index_tick(index: EventIndex, now):
+    index.advance(now)
+    return index.active_events(), index.next_boundary()
+
+
+def main(count=100_000, ticks=1000):
+    random.seed(0)
+    start = datetime(2026, 1, 1)
+    events = generate_events(count, start)
+    tick_times = [start + timedelta(days=180, minutes=15 * i) for i in range(ticks)]
+
+    t0 = timer()
+    index = EventIndex(events)
+    build_time = timer() - t0
+
+    t0 = timer()
+    for now in tick_times:
+        index_tick(index, now)
+    index_time = (timer() - t0) / ticks
+
+    # The linear scan is slow enough that a sample of ticks is plenty
+    sample = tick_times[::max(1, ticks // 20)]
+    t0 = timer()
+    for now in sample:
+        linear_scan_tick(events, now)
+    linear_time = (timer() - t0) / len(sample)
+
+    print(f"{count} events, {ticks} ticks 15 minutes apart")
+    print(f"EventIndex build:     {build_time * 1000:10.2f} ms")
+    print(f"EventIndex per tick:  {index_time * 1000:10.4f} ms")
+    print(f"Linear scan per tick: {linear_time * 1000:10.4f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,215 @@
+""" Benchmarks for the code that runs constantly on the device: the scheduler, saving schedule updates, rendering
+templates and building the banner message. Results are written to a JSON file, so runs on different commits can be
+compared.
+
+Run from the repository root:  python -m tests.benchmarks.hot_paths [--output results.json] [--compare old.json]
+
+Everything runs against a temporary SQLite database and an in-memory fake redis, so it's safe to run anywhere. Needs
+fakeredis with Lua support for the change feed (pip install "fakeredis[lua]"). PyQt5 isn't needed: without it, the
+rendering and banner benchmarks run against a stub of PyQt5.QtCore (see tests/qt_stub.py).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+from time import time
+from timeit import default_timer as timer
+
+import redis
+
+from settings import settings
+from tests.benchmarks.synthetic import generate_events, generate_slots, generate_templates
+from tests.qt_stub import install_qt_stub
+
+
+def measure(func, repeat=5, number=1, setup=None) -> dict:
+    """ Time func, number calls at a time, repeat times. setup runs before each repeat and isn't timed """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = timer()
+        for _ in range(number):
+            func()
+        times.append((timer() - t0) / number)
+    return {"repeat": repeat, "number": number, "min_ms": min(times) * 1000,
+            "median_ms": statistics.median(times) * 1000, "mean_ms": statistics.mean(times) * 1000}
+
+
+def use_temporary_environment(folder: str):
+    """ Point the database and asset folders at folder, and redis at an in-memory fake. Must run before anything
+    imports lib.models, which opens the database named in the settings """
+    import fakeredis
+    from lib import utils
+
+    assert "lib.models" not in sys.modules, "lib.models was imported before the settings were changed"
+    for name in ("images_folder", "original_images_folder", "image_derivatives_folder", "blobs_folder",
+                 "templates_folder", "jinja_cache_folder"):
+        settings[name] = os.path.join(folder, name, "")
+    settings["database"] = os.path.join(folder, "kenban.db")
+    settings["display_snapshot"] = os.path.join(folder, "display_snapshot.html")
+    settings["jobs_state"] = os.path.join(folder, "jobs.json")
+    settings["default_templates_folder"] = os.path.abspath("templates")
+    # FakeConnection was renamed FakeRedisConnection in fakeredis 2.x
+    connection_class = getattr(fakeredis, "FakeRedisConnection", None) or fakeredis.FakeConnection
+    utils.redis_pool = redis.ConnectionPool(connection_class=connection_class, server=fakeredis.FakeServer())
+
+
+def bench_upserts(slots, events, repeat) -> dict:
+    """ Saving slots and events one at a time, as websocket updates are, and all at once, as a full sync does. Leaves
+    them all in the database """
+    from lib.db_helper import create_or_update_schedule_slot, create_or_update_event, sync_all_schedule_slots, \
+        sync_all_events
+    from lib.models import Session, ScheduleSlot, Event
+
+    def one_at_a_time(func, rows):
+        with Session() as session:
+            for row in rows:
+                func(session, row)
+            session.commit()
+
+    def all_at_once(func, rows):
+        with Session() as session:
+            func(session, rows)
+            session.commit()
+
+    def clear(model):
+        with Session() as session:
+            session.query(model).delete()
+            session.commit()
+
+    results = {}
+    for name, func, save, model, rows in (
+            ("create_or_update_schedule_slot", create_or_update_schedule_slot, one_at_a_time, ScheduleSlot, slots),
+            ("create_or_update_event", create_or_update_event, one_at_a_time, Event, events),
+            ("sync_all_schedule_slots", sync_all_schedule_slots, all_at_once, ScheduleSlot, slots),
+            ("sync_all_events", sync_all_events, all_at_once, Event, events)):
+        # Inserting into an empty table, then updating rows that are already there
+        for suffix, setup in (("insert", lambda: clear(model)), ("update", None)):
+            result = measure(lambda: save(func, rows), repeat, setup=setup)
+            result["rows"] = len(rows)
+            result["rows_per_sec"] = len(rows) / result["median_ms"] * 1000
+            results[f"{name}_{suffix}"] = result
+    return results
+
+
+def bench_scheduler(repeat) -> dict:
+    from lib.scheduler import Scheduler
+
+    scheduler = Scheduler()
+    return {
+        "scheduler_init": measure(Scheduler, repeat),
+        "scheduler_tick": measure(scheduler.tick, repeat, number=1000),
+        "scheduler_update_assets_from_db": measure(scheduler.update_assets_from_db, repeat),
+    }
+
+
+def bench_display(repeat) -> dict:
+    install_qt_stub()
+    from lib.display_handler import DisplayHandler, DeviceStatus
+
+    handler = DisplayHandler()
+    slots = handler.scheduler.slots
+    # The events on at midday tomorrow, so the result doesn't depend on what time of day it's run
+    midday = datetime.combine(date.today() + timedelta(1), datetime.min.time()) + timedelta(hours=12)
+    events = handler.scheduler.event_index.active_at(midday)
+    position = [0]
+
+    def render_next_slot():
+        position[0] = (position[0] + 1) % len(slots)
+        handler.render_display_html(slots[position[0]], events)
+
+    def render_uncached():
+        handler.render_cache.renders.clear()
+        render_next_slot()
+
+    offline = DeviceStatus(internet_connected=False, last_connected=time() - 3600, websocket_connected=False,
+                           websocket_dc_timestamp=time() - 3600, rebooted=False, refresh_browser=False)
+    results = {
+        # A slot change or an event starting, when the page has to be rendered again
+        "render_display_html_uncached": measure(render_uncached, repeat, number=len(slots)),
+        # Redrawing a slot that hasn't changed
+        "render_display_html_cached": measure(lambda: handler.render_display_html(slots[0], events), repeat,
+                                              number=1000),
+        # Reads the status flags from redis, as the display loop does
+        "create_banner_message": measure(handler.create_banner_message, repeat, number=1000),
+        "create_banner_message_offline": measure(lambda: handler.create_banner_message(offline), repeat,
+                                                 number=1000),
+    }
+    for name in ("render_display_html_uncached", "render_display_html_cached"):
+        results[name]["events"] = len(events)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old: dict, new: dict):
+    """ Print how each median time changed between two result files """
+    print(f"\nCompared with {old['commit']} ({old['date']}):")
+    for name, result in new["results"].items():
+        before = old["results"].get(name, {}).get("median_ms")
+        after = result.get("median_ms")
+        if before and after:
+            print(f"{name:45} {before:10.4f} -> {after:10.4f} ms  {(after - before) / before:+7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slots-per-weekday", type=int, default=20)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--templates", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write results to. Defaults to benchmark-<commit>.json")
+    parser.add_argument("--compare", help="JSON results from an earlier run to compare against")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    commit = git_commit()
+    with tempfile.TemporaryDirectory(prefix="kenban-benchmark-") as folder:
+        use_temporary_environment(folder)
+        from lib.models import init_db
+        init_db()
+
+        template_uuids = generate_templates(args.templates, settings["templates_folder"])
+        slots = generate_slots(args.slots_per_weekday, template_uuids)
+        events = generate_events(args.events, around=datetime.now())
+
+        results = {}
+        results.update(bench_upserts(slots, events, args.repeat))
+        results.update(bench_scheduler(args.repeat))
+        results.update(bench_display(args.repeat))
+
+    report = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "results": results,
+    }
+    for name, result in results.items():
+        print(f"{name:45} {result['median_ms']:10.4f} ms")
+    output = args.output or f"benchmark-{commit}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+""" Synthetic schedules for the benchmarks, in the same shape the server sends them. Seed random first for repeatable
+data.
+"""
+import os
+import random
+from datetime import datetime, timedelta
+from typing import List
+
+from lib.utils import WEEKDAY_DICT
+
+TEXTS = ["", "Welcome", "Staff meeting in the hall at 3pm", "Fire drill today. Please follow the instructions of the "
+         "fire marshals and leave the building by the nearest exit"]
+
+# Loops over the events and uses filters, like the templates users build
+TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <title>{{{{ slot.display_text }}}}</title>
+  <style>body {{ background: #{colour}; }} .event {{ font-size: {size}px; }}</style>
+</head>
+<body>
+  <img src="{{{{ slot.foreground_image_uuid }}}}" alt="">
+  <h1>{{{{ slot.display_text | upper }}}}</h1>
+  <p class="time">{{{{ slot.start_time.strftime("%H:%M") }}}} {{{{ slot.weekday }}}}</p>
+  {{% if events %}}
+  <ul>
+    {{% for event in events | sort(attribute="event_start") %}}
+    <li class="event{{% if event.override %}} override{{% endif %}}">
+      <img src="{{{{ event.foreground_image_uuid }}}}" alt="">
+      {{{{ event.display_text | e }}}}
+      <span>{{{{ event.event_start.strftime("%a %H:%M") }}}} - {{{{ event.event_end.strftime("%H:%M") }}}}</span>
+    </li>
+    {{% endfor %}}
+  </ul>
+  {{% endif %}}
+  {padding}
+</body>
+</html>
+"""
+
+
+def generate_templates(count: int, folder: str) -> List[str]:
+    """ Write count templates of a few kB each to folder. Returns their uuids """
+    os.makedirs(folder, exist_ok=True)
+    uuids = []
+    for i in range(count):
+        uuid = f"template-{i}"
+        padding = "\n  ".join(f'<div class="decoration-{j}"><span>{random.choice(TEXTS)}</span></div>'
+                              for j in range(random.randrange(10, 60)))
+        with open(os.path.join(folder, uuid), "w") as f:
+            f.write(TEMPLATE.format(colour=f"{random.randrange(0xffffff):06x}", size=random.randrange(20, 60),
+                                    padding=padding))
+        uuids.append(uuid)
+    return uuids
+
+
+def generate_slots(per_weekday: int, template_uuids: List[str], images=50) -> List[dict]:
+    """ per_weekday slots on each day of the week, at distinct times """
+    slots = []
+    minutes = range(0, 24 * 60, max(1, 24 * 60 // per_weekday))
+    for weekday in WEEKDAY_DICT:
+        for start in sorted(random.sample(minutes, min(per_weekday, len(minutes)))):
+            slots.append({
+                "uuid": f"slot-{len(slots)}",
+                "template_uuid": random.choice(template_uuids),
+                "foreground_image_uuid": f"image-{random.randrange(images)}",
+                "display_text": random.choice(TEXTS),
+                "time_format": random.choice([12, 24]),
+                "start_time": f"{start // 60:02d}:{start % 60:02d}",
+                "weekday": weekday,
+            })
+    return slots
+
+
+def generate_events(count: int, around: datetime, days=30, images=50) -> List[dict]:
+    """ Events over the weeks either side of around, clustered in working hours so several overlap at a time. Most
+    last an hour or two, some all day and a few several days """
+    events = []
+    for i in range(count):
+        day = around.date() + timedelta(days=random.randrange(-days, days))
+        start = datetime.combine(day, datetime.min.time()) + timedelta(hours=random.triangular(7, 19, 10),
+                                                                       minutes=random.choice([0, 15, 30, 45]))
+        start = start.replace(second=0, microsecond=0)
+        length = timedelta(minutes=random.choices([30, 60, 120, 9 * 60, 3 * 24 * 60], weights=[3, 5, 3, 2, 1])[0])
+        events.append({
+            "uuid": f"event-{i}",
+            "foreground_image_uuid": f"image-{random.randrange(images)}",
+            "display_text": random.choice(TEXTS),
+            "event_start": start.isoformat(),
+            "event_end": (start + length).isoformat(),
+            "override": random.random() < 0.1,
+        })
+    return events
@@ -0,0 +1,27 @@
+import pytest
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from lib import utils
+from lib.models import Base, Session
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """ An empty in-memory redis behind lib.utils.connect_to_redis. Needs fakeredis[lua], for the change feed """
+    fakeredis = pytest.importorskip("fakeredis")
+    connection_class = getattr(fakeredis, "FakeRedisConnection", None) or fakeredis.FakeConnection
+    pool = redis.ConnectionPool(connection_class=connection_class, server=fakeredis.FakeServer())
+    monkeypatch.setattr(utils, "redis_pool", pool)
+    return utils.connect_to_redis()
+
+
+@pytest.fixture
+def db(monkeypatch, fake_redis):
+    """ Point Session at an empty in-memory database. Commits publish to the fake redis """
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    monkeypatch.setitem(Session.kw, "bind", engine)
+    yield engine
+    engine.dispose()
@@ -0,0 +1,41 @@
+""" Lets lib.display_handler be imported where PyQt5 isn't installed, e.g. to test or benchmark it on a plain Linux box.
+Only QThread and pyqtSignal are stubbed: signals do nothing when emitted and the thread never starts """
+import sys
+import types
+
+
+class QThread(object):
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start(self):
+        pass
+
+
+class Signal(object):
+
+    def __init__(self, *types):
+        self.types = types
+
+    def connect(self, slot):
+        pass
+
+    def emit(self, *args):
+        pass
+
+
+def install_qt_stub():
+    """ Put a stub PyQt5.QtCore in sys.modules, unless the real one can be imported """
+    try:
+        import PyQt5.QtCore  # noqa: F401
+        return
+    except ImportError:
+        pass
+    qt_core = types.ModuleType("PyQt5.QtCore")
+    qt_core.QThread = QThread
+    qt_core.pyqtSignal = Signal
+    pyqt5 = types.ModuleType("PyQt5")
+    pyqt5.QtCore = qt_core
+    sys.modules["PyQt5"] = pyqt5
+    sys.modules["PyQt5.QtCore"] = qt_core
@@ -0,0 +1,77 @@
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from lib import asset_store
+from lib.asset_store import IMAGE, TEMPLATE, asset_paths, enforce_quota, ingest, record_stats
+from lib.db_helper import create_or_update_schedule_slot, create_or_update_event
+from lib.downloads import DownloadResult
+from lib.models import Session, Asset
+from settings import settings
+
+FOLDERS = ("blobs_folder", "original_images_folder", "images_folder", "templates_folder", "image_derivatives_folder")
+
+
+@pytest.fixture
+def store(db, tmp_path, monkeypatch):
+    for folder in FOLDERS:
+        monkeypatch.setitem(settings, folder, str(tmp_path / folder))
+        os.makedirs(settings[folder])
+
+
+def add_asset(kind, uuid, content, last_used):
+    fp = asset_paths(kind, uuid)[0]
+    with open(fp, "w") as f:
+        f.write(content)
+    sha256 = hashlib.sha256(content.encode()).hexdigest()
+    ingest(kind, uuid, DownloadResult(url="", path=fp, size=len(content), seconds=0, sha256=sha256))
+    with Session() as session:
+        session.add(Asset(kind=kind, uuid=uuid, sha256=sha256, size=len(content), last_used=last_used))
+        session.commit()
+
+
+def add_event(uuid, image_uuid, start):
+    with Session() as session:
+        create_or_update_event(session, {"uuid": uuid, "foreground_image_uuid": image_uuid, "display_text": "",
+                                         "event_start": start.isoformat(),
+                                         "event_end": (start + timedelta(hours=2)).isoformat()})
+        session.commit()
+
+
+def test_eviction_keeps_scheduled_assets(store):
+    now = datetime.now()
+    with Session() as session:
+        create_or_update_schedule_slot(session, {"uuid": "slot", "template_uuid": "slot-template",
+                                                 "foreground_image_uuid": "slot-image", "display_text": "",
+                                                 "time_format": 24, "start_time": "09:00", "weekday": "Monday"})
+        session.commit()
+    add_event("current", "current-image", now - timedelta(hours=1))
+    add_event("upcoming", "upcoming-image", now + timedelta(days=1))
+    add_event("past", "past-image", now - timedelta(days=1))
+
+    # The scheduled assets are the least recently used, so would be evicted first if they weren't protected
+    protected = [(TEMPLATE, "slot-template", '<img src="template-image">'), (IMAGE, "slot-image", "slot"),
+                 (IMAGE, "template-image", "template"), (IMAGE, "current-image", "current"),
+                 (IMAGE, "upcoming-image", "upcoming")]
+    unused = [(IMAGE, "past-image", "past"), (IMAGE, "old-image", "old"), (TEMPLATE, "old-template", "<p></p>")]
+    for i, (kind, uuid, content) in enumerate(protected + unused):
+        add_asset(kind, uuid, content, last_used=now - timedelta(days=30) + timedelta(hours=i))
+
+    result = enforce_quota(quota=0)
+    assert result.evicted == len(unused)
+    assert result.bytes_used > 0  # Still over quota, with only scheduled assets left
+    for kind, uuid, _ in protected:
+        assert os.path.exists(asset_paths(kind, uuid)[0])
+    for kind, uuid, _ in unused:
+        assert not os.path.exists(asset_paths(kind, uuid)[0])
+    with Session() as session:
+        evicted = {(a.kind, a.uuid) for a in session.query(Asset).filter(Asset.evicted.is_(True))}
+    assert evicted == {(kind, uuid) for kind, uuid, _ in unused}
+
+
+def test_hit_rate_is_exported(store):
+    record_stats(hits=3, misses=1)
+    enforce_quota()
+    assert list(asset_store.STORE_HIT_RATE.samples()) == [("kenban_asset_store_hit_rate", {}, 0.75)]
@@ -0,0 +1,30 @@
+from time import time
+
+import jwt
+
+from lib import authentication
+from settings import settings
+
+
+def make_token(expires_in):
+    return jwt.encode({"exp": time() + expires_in}, "secret", algorithm="HS256")
+
+
+def test_refresh_that_outlasts_its_lock_is_not_repeated(fake_redis, monkeypatch):
+    monkeypatch.setattr(authentication, "_cached_access_token", None)
+    monkeypatch.setattr(authentication, "_cached_expiry", 0)
+    monkeypatch.setitem(settings, "access_token", make_token(-60))
+    refreshed = make_token(3600)
+    refreshes = []
+
+    def slow_refresh():
+        refreshes.append(1)
+        # Longer than REFRESH_LOCK_TIMEOUT, so the lock expires before it's released
+        fake_redis.delete(authentication.REFRESH_LOCK)
+        authentication.cache_access_token(refreshed)
+        return refreshed
+
+    monkeypatch.setattr(authentication, "refresh_access_token", slow_refresh)
+    assert authentication.get_access_token() == refreshed
+    assert refreshes == [1]
+    assert authentication.shared_access_token() == refreshed
@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+
+import redis
+
+from lib import change_feed, scheduler as scheduler_module
+from lib.db_helper import create_or_update_schedule_slot, create_or_update_event
+from lib.models import Session, Event
+from lib.scheduler import Scheduler, FEED_RETRY_DELAY
+
+
+def make_slot(uuid, start_time="09:00"):
+    return {"uuid": uuid, "template_uuid": "template", "foreground_image_uuid": "image", "display_text": "",
+            "time_format": 24, "start_time": start_time, "weekday": "Monday"}
+
+
+def make_event(uuid, hours_from_now=-1):
+    start = datetime.now() + timedelta(hours=hours_from_now)
+    return {"uuid": uuid, "foreground_image_uuid": "image", "display_text": "",
+            "event_start": start.isoformat(), "event_end": (start + timedelta(hours=2)).isoformat()}
+
+
+def save(func, *payloads):
+    with Session() as session:
+        for payload in payloads:
+            func(session, payload)
+        session.commit()
+
+
+def counting_reloads(scheduler, monkeypatch):
+    reloads = []
+    reload = scheduler.update_assets_from_db
+
+    def update_assets_from_db():
+        reloads.append(1)
+        reload()
+
+    monkeypatch.setattr(scheduler, "update_assets_from_db", update_assets_from_db)
+    return reloads
+
+
+def test_changes_are_applied_without_a_reload(db, monkeypatch):
+    save(create_or_update_schedule_slot, make_slot("a"))
+    scheduler = Scheduler()
+    reloads = counting_reloads(scheduler, monkeypatch)
+
+    save(create_or_update_schedule_slot, make_slot("b", "12:00"), make_slot("a", "15:00"))
+    save(create_or_update_event, make_event("active"), make_event("later", hours_from_now=5))
+    scheduler.apply_changes()
+    assert [(s.uuid, s.start_time.hour) for s in scheduler.slots] == [("b", 12), ("a", 15)]
+    assert [e.uuid for e in scheduler.active_events] == ["active"]
+    assert set(scheduler.event_index.events) == {"active", "later"}
+
+    with Session() as session:
+        session.query(Event).filter_by(uuid="active").delete()
+        session.info["schedule_changes"] = [(change_feed.EVENT, "active", change_feed.DELETE)]
+        session.commit()
+    scheduler.apply_changes()
+    assert scheduler.active_events == []
+    assert set(scheduler.event_index.events) == {"later"}
+    assert reloads == []
+
+
+def test_gap_in_feed_reloads_everything(db, fake_redis, monkeypatch):
+    scheduler = Scheduler()
+    reloads = counting_reloads(scheduler, monkeypatch)
+    position = scheduler.change_position
+    # A record that was trimmed away before it was read
+    fake_redis.incr(change_feed.CHANGE_SEQ)
+    save(create_or_update_schedule_slot, make_slot("a"))
+    assert change_feed.changes_since(position) is None
+    scheduler.apply_changes()
+    assert reloads == [1]
+    assert [s.uuid for s in scheduler.slots] == ["a"]
+    # Carries on from the reload's position
+    scheduler.apply_changes()
+    assert reloads == [1]
+
+
+def test_reload_record_reloads_everything(db, monkeypatch):
+    scheduler = Scheduler()
+    reloads = counting_reloads(scheduler, monkeypatch)
+    change_feed.publish_changes([(change_feed.SCHEDULE_SLOT, f"slot-{i}", change_feed.UPSERT)
+                                 for i in range(change_feed.MAX_CHANGES_PER_PUBLISH + 1)])
+    changes = change_feed.changes_since(scheduler.change_position)
+    assert [c.op for c in changes] == [change_feed.RELOAD]
+    scheduler.apply_changes()
+    assert reloads == [1]
+
+
+def test_unavailable_feed_falls_back_to_db_mtime(db, monkeypatch):
+    scheduler = Scheduler()
+    reloads = counting_reloads(scheduler, monkeypatch)
+
+    def unavailable(position):
+        raise redis.exceptions.ConnectionError()
+
+    monkeypatch.setattr(change_feed, "changes_since", unavailable)
+    monkeypatch.setattr(scheduler_module, "get_db_mtime", lambda: scheduler.last_update_db_mtime)
+    scheduler.apply_changes()
+    assert reloads == []
+    monkeypatch.setattr(scheduler_module, "get_db_mtime", lambda: scheduler.last_update_db_mtime + 1)
+    scheduler.apply_changes()
+    assert reloads == [1]
+
+
+def test_feed_is_retried_with_backoff_and_reloads_once_back(db, monkeypatch):
+    clock = [1000]
+    monkeypatch.setattr(scheduler_module, "monotonic", lambda: clock[0])
+    latest_position = change_feed.latest_position
+    attempts = []
+
+    def unavailable():
+        attempts.append(clock[0])
+        raise redis.exceptions.ConnectionError()
+
+    monkeypatch.setattr(change_feed, "latest_position", unavailable)
+    scheduler = Scheduler()
+    assert scheduler.change_position is None
+    reloads = counting_reloads(scheduler, monkeypatch)
+    monkeypatch.setattr(scheduler_module, "get_db_mtime", lambda: scheduler.last_update_db_mtime)
+    for _ in range(3):
+        scheduler.apply_changes()
+        clock[0] += FEED_RETRY_DELAY
+    # Tried at creation, then after FEED_RETRY_DELAY, then waiting twice as long
+    assert attempts == [1000, 1000 + FEED_RETRY_DELAY]
+    assert reloads == []
+
+    monkeypatch.setattr(change_feed, "latest_position", latest_position)
+    save(create_or_update_schedule_slot, make_slot("a"))
+    scheduler.apply_changes()
+    assert reloads == [1]
+    assert [s.uuid for s in scheduler.slots] == ["a"]
+    assert scheduler.change_position is not None
+
+    save(create_or_update_schedule_slot, make_slot("b", "12:00"))
+    scheduler.apply_changes()
+    assert reloads == [1]
+    assert [s.uuid for s in scheduler.slots] == ["a", "b"]
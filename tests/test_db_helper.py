@@ -0,0 +1,84 @@
+from lib import change_feed, sync
+from lib.db_helper import sync_all_schedule_slots, sync_all_events, UPSERT_CHUNK_SIZE
+from lib.models import Session, ScheduleSlot, Event
+
+
+def make_slot(uuid, display_text=""):
+    return {"uuid": uuid, "template_uuid": "template", "foreground_image_uuid": "image", "display_text": display_text,
+            "time_format": 24, "start_time": "09:00", "weekday": "Monday"}
+
+
+def make_event(uuid, display_text=""):
+    return {"uuid": uuid, "foreground_image_uuid": "image", "display_text": display_text,
+            "event_start": "2026-01-01T09:00:00", "event_end": "2026-01-01T10:00:00", "override": False}
+
+
+def save(func, rows):
+    with Session() as session:
+        func(session, rows)
+        session.commit()
+
+
+def stored(model):
+    with Session() as session:
+        return {row.uuid: row.display_text for row in session.query(model)}
+
+
+def published_changes():
+    return [(c.entity, c.uuid, c.op) for c in change_feed.changes_since(("0-0", 0))]
+
+
+def test_sync_updates_existing_and_adds_new_rows(db):
+    save(sync_all_schedule_slots, [make_slot("a", "old"), make_slot("b", "kept")])
+    save(sync_all_schedule_slots, [make_slot("a", "new"), make_slot("b", "kept"), make_slot("c", "added")])
+    assert stored(ScheduleSlot) == {"a": "new", "b": "kept", "c": "added"}
+
+
+def test_sync_deletes_rows_missing_from_server(db):
+    save(sync_all_events, [make_event("a"), make_event("b"), make_event("c")])
+    save(sync_all_events, [make_event("b")])
+    assert stored(Event) == {"b": ""}
+
+
+def test_sync_with_empty_list_from_server_deletes_everything(db, monkeypatch):
+    save(sync_all_schedule_slots, [make_slot("a")])
+    save(sync_all_events, [make_event("a")])
+    # An empty list means the user really has removed everything
+    monkeypatch.setattr(sync, "kenban_server_request", lambda **kwargs: [])
+    monkeypatch.setattr(sync, "get_auth_header", lambda: {})
+    assert sync.sync_schedule_slots() is True
+    assert sync.sync_events() is True
+    assert stored(ScheduleSlot) == {}
+    assert stored(Event) == {}
+
+
+def test_sync_keeps_rows_when_server_request_fails(db, monkeypatch):
+    save(sync_all_events, [make_event("a")])
+    monkeypatch.setattr(sync, "kenban_server_request", lambda **kwargs: None)
+    monkeypatch.setattr(sync, "get_auth_header", lambda: {})
+    assert sync.sync_events() is None
+    assert stored(Event) == {"a": ""}
+
+
+def test_sync_in_chunks(db):
+    count = UPSERT_CHUNK_SIZE * 2 + 50
+    save(sync_all_events, [make_event(f"event-{i}", "v1") for i in range(count)])
+    assert len(stored(Event)) == count
+    # Update every row and delete more than a chunk's worth
+    keep = UPSERT_CHUNK_SIZE + 10
+    save(sync_all_events, [make_event(f"event-{i}", "v2") for i in range(keep)])
+    assert stored(Event) == {f"event-{i}": "v2" for i in range(keep)}
+
+
+def test_sync_publishes_changes(db):
+    save(sync_all_schedule_slots, [make_slot("a"), make_slot("b")])
+    save(sync_all_schedule_slots, [make_slot("b"), make_slot("c")])
+    changes = published_changes()
+    assert sorted(changes[:2]) == [("schedule_slot", "a", "upsert"), ("schedule_slot", "b", "upsert")]
+    assert sorted(changes[2:]) == [("schedule_slot", "a", "delete"), ("schedule_slot", "b", "upsert"),
+                                   ("schedule_slot", "c", "upsert")]
+
+
+def test_large_sync_publishes_one_reload(db):
+    save(sync_all_events, [make_event(f"event-{i}") for i in range(change_feed.MAX_CHANGES_PER_PUBLISH + 1)])
+    assert published_changes() == [("all", "", "reload")]
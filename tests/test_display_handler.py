@@ -0,0 +1,91 @@
+import pytest
+
+from qt_stub import install_qt_stub
+
+install_qt_stub()
+
+from lib import display_handler  # noqa: E402
+from lib.db_helper import create_or_update_schedule_slot  # noqa: E402
+from lib.models import Session  # noqa: E402
+from settings import settings  # noqa: E402
+
+SNAPSHOT = "<p>Last known screen</p>"
+
+
+class Screen(object):
+    """ Stands in for the viewer, recording each page it's sent """
+
+    def __init__(self):
+        self.pages = []
+
+    def emit(self, html, *args):
+        self.pages.append(html)
+
+
+@pytest.fixture
+def handler(db, tmp_path, monkeypatch):
+    monkeypatch.setitem(settings, "display_snapshot", str(tmp_path / "display_snapshot.html"))
+    monkeypatch.setattr(display_handler, "EMPTY_PL_DELAY", 0)
+    handler = display_handler.DisplayHandler()
+    handler.screen = Screen()
+    handler.default_template = handler.user_template = handler.screen
+    handler.standby = Screen()
+    handler.prerender_template = handler.standby
+    monkeypatch.setattr(handler, "wait_until", lambda deadline: None)
+    display_handler.save_display_snapshot(SNAPSHOT)
+    return handler
+
+
+def save_slots(*weekdays):
+    with Session() as session:
+        for weekday in weekdays:
+            create_or_update_schedule_slot(session, {"uuid": weekday, "template_uuid": "template",
+                                                     "foreground_image_uuid": "image", "display_text": weekday,
+                                                     "time_format": 24, "start_time": "09:00", "weekday": weekday})
+        session.commit()
+
+
+def test_snapshot_stays_up_while_schedule_is_empty(handler):
+    assert handler.show_last_known_screen()
+    handler.display_loop()
+    handler.display_loop()
+    assert handler.screen.pages == [SNAPSHOT]
+
+
+def test_snapshot_stays_up_until_schedule_renders(handler, monkeypatch):
+    save_slots("Monday")
+    handler.scheduler.update_assets_from_db()
+
+    def not_synced_yet(slot, events):
+        raise FileNotFoundError("template")
+
+    monkeypatch.setattr(handler, "render_display_html", not_synced_yet)
+    assert handler.show_last_known_screen()
+    handler.display_loop()
+    assert handler.screen.pages == [SNAPSHOT]
+
+    monkeypatch.setattr(handler, "render_display_html", lambda slot, events: "<p>Schedule</p>")
+    monkeypatch.setattr(handler, "page_key", lambda slot: slot.template_uuid)
+    handler.display_loop()
+    assert handler.screen.pages == [SNAPSHOT, "<p>Schedule</p>"]
+    assert not handler.showing_snapshot
+
+
+def test_next_slot_is_prerendered_again_once_the_standby_page_is_used(handler, monkeypatch):
+    save_slots("Monday", "Thursday")
+    handler.scheduler.update_assets_from_db()
+    monkeypatch.setattr(handler, "render_display_html", lambda slot, events: f"<p>{slot.display_text}</p>")
+    monkeypatch.setattr(handler, "page_key", lambda slot: slot.template_uuid)
+    html = f"<p>{handler.scheduler.next_slot.display_text}</p>"
+
+    handler.prerender_next_slot()
+    assert handler.standby.pages == [html]
+    # The slot starts and the viewer swaps the standby page in, so the next prerender must load it again
+    handler.show_user_template(html, "template")
+    handler.prerendered_start = None
+    handler.prerender_next_slot()
+    assert handler.standby.pages == [html, html]
+
+    handler.invalidate_prerender("schedule changed")
+    handler.prerender_next_slot()
+    assert handler.standby.pages == [html, html, html]
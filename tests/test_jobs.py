@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+from lib.jobs import CronSchedule, Job, JobRunner
+
+MONDAY = datetime(2026, 1, 5, 12, 0)
+
+
+def test_cron_schedule_next_run():
+    schedule = CronSchedule(minute=30, hour="9,17", day_of_week="0,1,2,3,4")
+    assert schedule.next_run(MONDAY) == datetime(2026, 1, 5, 17, 30)
+    assert schedule.next_run(datetime(2026, 1, 5, 17, 30)) == datetime(2026, 1, 6, 9, 30)
+    # Friday evening to Monday morning
+    assert schedule.next_run(datetime(2026, 1, 9, 18, 0)) == datetime(2026, 1, 12, 9, 30)
+
+
+def test_cron_schedule_jitter_is_stable():
+    a = CronSchedule(minute=0, hour=0, day_of_week=0, jitter=timedelta(weeks=1), seed="device-a")
+    again = CronSchedule(minute=0, hour=0, day_of_week=0, jitter=timedelta(weeks=1), seed="device-a")
+    b = CronSchedule(minute=0, hour=0, day_of_week=0, jitter=timedelta(weeks=1), seed="device-b")
+    assert a.offset == again.offset
+    assert a.offset != b.offset
+    first = a.next_run(MONDAY)
+    assert timedelta(0) < first - MONDAY <= timedelta(weeks=1)
+    assert a.next_run(first) == first + timedelta(weeks=1)
+
+
+def test_job_runner_catches_up_missed_runs(tmp_path):
+    runs = []
+    runner = JobRunner([Job("weekly", lambda: runs.append("weekly"), CronSchedule(minute=0, hour=0, day_of_week=0)),
+                        Job("on_demand", lambda: runs.append("on_demand"))],
+                       state_file=str(tmp_path / "jobs.json"))
+    runner.load_state()
+    runner.run_pending()
+    assert runs == []  # First start: nothing has been missed yet
+
+    # Last ran weeks ago, e.g. the device was switched off
+    runner.last_runs["weekly"] = datetime.now() - timedelta(weeks=3)
+    runner.save_state()
+    runner.load_state()
+    next_run = runner.run_pending()
+    assert runs == ["weekly"]  # Only once, however many runs were missed
+    assert next_run > datetime.now()
+
+    runner.trigger(b"on_demand")
+    runner.run_pending()
+    assert runs == ["weekly", "on_demand"]
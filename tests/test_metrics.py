@@ -0,0 +1,40 @@
+import os
+
+from lib import metrics
+from settings import settings
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = metrics.histogram("test_histogram_seconds", "Test", buckets=(0.1, 1), case="buckets")
+    for value in (0.05, 0.1, 0.5, 5):
+        hist.observe(value)
+    samples = {(name, labels.get("le")): value for name, labels, value in hist.samples()}
+    assert samples[("test_histogram_seconds_bucket", "0.1")] == 2
+    assert samples[("test_histogram_seconds_bucket", "1.0")] == 3
+    assert samples[("test_histogram_seconds_bucket", "+Inf")] == 4
+    assert samples[("test_histogram_seconds_count", None)] == 4
+    assert samples[("test_histogram_seconds_sum", None)] == 5.65
+
+
+def test_gauge_keeps_latest_value():
+    gauge = metrics.gauge("test_gauge", "Test")
+    gauge.set(5)
+    gauge.set(0.5)
+    assert list(gauge.samples()) == [("test_gauge", {}, 0.5)]
+
+
+def test_prometheus_textfile(tmp_path, monkeypatch):
+    ok = metrics.counter("test_requests_total", "Test requests", result="ok")
+    failed = metrics.counter("test_requests_total", "Test requests", result="failed")
+    assert metrics.counter("test_requests_total", "Test requests", result="ok") is ok
+    ok.inc()
+    ok.inc(2)
+    failed.inc()
+    monkeypatch.setitem(settings, "metrics_folder", str(tmp_path))
+    metrics.write_textfile("test")
+    with open(os.path.join(tmp_path, "kenban_test.prom")) as f:
+        text = f.read()
+    assert text.count("# TYPE test_requests_total counter") == 1
+    assert 'test_requests_total{result="ok",process="test"} 3' in text
+    assert 'test_requests_total{result="failed",process="test"} 1' in text
+    assert os.listdir(tmp_path) == ["kenban_test.prom"]
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+from lib.models import Event
+from lib.scheduler import EventIndex
+
+START = datetime(2026, 1, 1, 9, 0)
+
+
+def make_event(uuid, start_offset_hours, length_hours):
+    event_start = START + timedelta(hours=start_offset_hours)
+    return Event(uuid=uuid, event_start=event_start, event_end=event_start + timedelta(hours=length_hours))
+
+
+def active_uuids(index):
+    return [e.uuid for e in index.active_events()]
+
+
+def test_event_index_tracks_active_events():
+    index = EventIndex([make_event("a", 0, 2), make_event("b", 1, 2), make_event("c", 5, 1)])
+    index.advance(START + timedelta(minutes=30))
+    assert active_uuids(index) == ["a"]
+    assert index.next_boundary() == START + timedelta(hours=1)
+    index.advance(START + timedelta(hours=2, minutes=30))
+    assert active_uuids(index) == ["b"]
+    index.advance(START + timedelta(hours=5, minutes=30))
+    assert active_uuids(index) == ["c"]
+    assert index.next_boundary() == START + timedelta(hours=6)
+
+
+def test_event_index_add_and_remove():
+    index = EventIndex([make_event("a", 0, 2)])
+    index.advance(START + timedelta(hours=1))
+    index.add(make_event("b", 0, 3))
+    assert active_uuids(index) == ["a", "b"]
+    # Moving an active event into the future deactivates it
+    index.add(make_event("a", 4, 1))
+    assert active_uuids(index) == ["b"]
+    assert index.next_boundary() == START + timedelta(hours=3)
+    index.remove("b")
+    assert active_uuids(index) == []
+    assert index.next_boundary() == START + timedelta(hours=4)
+
+
+def test_event_index_clock_going_backwards():
+    index = EventIndex([make_event("a", 0, 2)])
+    index.advance(START + timedelta(hours=3))
+    assert active_uuids(index) == []
+    index.advance(START + timedelta(hours=1))
+    assert active_uuids(index) == ["a"]
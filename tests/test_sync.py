@@ -1,5 +1,21 @@
+from lib import metrics, sync
 from lib.sync import full_sync
 
 
 def test_full_sync():
     full_sync()
+
+
+def test_pool_stats_are_counted_across_resets(monkeypatch):
+    readings = iter([{"hits": 10, "misses": 2}, {"hits": 15, "misses": 3}, {"hits": 4, "misses": 1}])
+    monkeypatch.setattr(sync, "pool_stats", lambda: next(readings))
+    monkeypatch.setattr(sync, "last_pool_stats", {"hits": 0, "misses": 0})
+    hits = metrics.counter("kenban_http_pool_requests_total", "", result="hit")
+    misses = metrics.counter("kenban_http_pool_requests_total", "", result="miss")
+    start = hits.value, misses.value
+    totals = []
+    for _ in range(3):
+        sync.record_pool_stats()
+        totals.append((hits.value - start[0], misses.value - start[1]))
+    # The last reading is after the session was recreated, so all of it is new
+    assert totals == [(10, 2), (15, 3), (19, 4)]
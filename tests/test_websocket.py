@@ -0,0 +1,65 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+import websocket
+from websocket import MessageDispatcher, UpdateCoalescer
+
+
+def test_messages_about_the_same_entity_run_in_order():
+    handled = []
+    lock = threading.Lock()
+
+    def handler(payload):
+        sleep(payload["delay"])
+        with lock:
+            handled.append(payload["name"])
+
+    async def dispatch():
+        dispatcher = MessageDispatcher(handler)
+        await dispatcher.submit("a", {"name": "a1", "delay": 0.2})
+        await dispatcher.submit("a", {"name": "a2", "delay": 0})
+        await dispatcher.submit("b", {"name": "b1", "delay": 0})
+        await asyncio.gather(*dispatcher.latest.values())
+        dispatcher.executor.shutdown()
+
+    asyncio.run(dispatch())
+    # b1 didn't wait for the slow a1, but a2 did
+    assert handled == ["b1", "a1", "a2"]
+
+
+def test_updates_within_the_window_are_coalesced(monkeypatch):
+    batches = []
+    monkeypatch.setattr(websocket, "apply_schedule_updates", batches.append)
+
+    async def coalesce():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            coalescer = UpdateCoalescer(executor)
+            coalescer.submit(("event", "a"), {"uuid": "a", "version": 1})
+            coalescer.submit(("event", "b"), {"uuid": "b", "version": 1})
+            coalescer.submit(("event", "a"), {"uuid": "a", "version": 2})
+            await coalescer.flush_task
+            coalescer.submit(("event", "a"), {"uuid": "a", "version": 3})
+            await coalescer.flush_task
+
+    asyncio.run(coalesce())
+    assert batches == [[{"uuid": "b", "version": 1}, {"uuid": "a", "version": 2}], [{"uuid": "a", "version": 3}]]
+
+
+def test_overflow_triggers_one_full_sync(monkeypatch):
+    batches = []
+    triggered = []
+    monkeypatch.setattr(websocket, "apply_schedule_updates", batches.append)
+    monkeypatch.setattr(websocket, "trigger_job", triggered.append)
+
+    async def coalesce():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            coalescer = UpdateCoalescer(executor)
+            for i in range(websocket.MAX_COALESCED_UPDATES * 2):
+                coalescer.submit(("schedule_slot", str(i)), {"uuid": str(i)})
+            await coalescer.flush_task
+
+    asyncio.run(coalesce())
+    assert triggered == ["full_sync"]
+    assert batches == []
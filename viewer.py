@@ -1,18 +1,22 @@
 import logging.config
 import sys
 from pathlib import Path
+from timeit import default_timer as timer
 
 from PyQt5.QtCore import QUrl, Qt
 from PyQt5.QtGui import QCursor
 from PyQt5.QtWebEngineWidgets import QWebEngineView
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QStackedWidget
 
-from lib.display_handler import DisplayHandler
-from lib.models import Base, engine
+from lib import metrics
+from lib.display_handler import DisplayHandler, default_templates_env
+from lib.dom_patch import patch_script
+from lib.models import init_db
+from lib.utils import seconds_since_boot
 from settings import settings
 
-Base.metadata.create_all(engine)
+viewer_started = timer()
+init_db()
 
 app = QApplication(sys.argv)
 
@@ -21,10 +25,45 @@ logs_path.mkdir(exist_ok=True)
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
 logger = logging.getLogger("viewer")
 
-default_templates_env = Environment(
-    loader=FileSystemLoader(settings["default_templates_folder"]),
-    autoescape=select_autoescape()
-)
+PAGE_LOAD_SECONDS = metrics.histogram("kenban_page_load_seconds", "Time from setHtml until the page has loaded")
+PAGE_LOAD_FAILURES = metrics.counter("kenban_page_load_failures_total", "Pages that failed to load")
+PAGE_PATCH_SECONDS = metrics.histogram("kenban_page_patch_seconds", "Time taken to patch a page in place")
+PAGE_PATCH_FALLBACKS = metrics.counter("kenban_page_patch_fallbacks_total",
+                                       "Pages that couldn't be patched, so were reloaded")
+
+
+class DisplayPage(object):
+    """ A web view, and the user page loaded in it """
+
+    def __init__(self):
+        self.view = QWebEngineView()
+        self.view.loadFinished.connect(self.on_load_finished)
+        # The user page loaded, so the next render of the same template can be patched in instead of reloading the
+        # whole page. None while anything else is loaded
+        self.key = None
+        self.html = None
+        self.loaded = False
+        self.load_started = None
+
+    def on_load_finished(self, ok):
+        self.loaded = ok
+        if self.load_started is not None:
+            PAGE_LOAD_SECONDS.observe(timer() - self.load_started)
+            self.load_started = None
+        if not ok:
+            PAGE_LOAD_FAILURES.inc()
+
+    def load(self, html, key, base_folder):
+        self.key = key
+        self.html = html
+        self.loaded = False
+        # Unloading a page (clear) isn't worth timing
+        self.load_started = timer() if html else None
+        self.view.setHtml(html, baseUrl=QUrl(f"file://{base_folder}"))
+
+    def clear(self):
+        """ Unload the page, to free its memory """
+        self.load("", None, settings['default_images_folder'])
 
 
 class WebEngineView(QWidget):
@@ -32,7 +71,11 @@ class WebEngineView(QWidget):
     def __init__(self):
         super(WebEngineView, self).__init__()
         self.thread = None
-        self.webEngineView = None
+        self.stack = None
+        # The page on screen, and one kept off-screen to load the next slot into before it starts
+        self.active = None
+        self.standby = None
+        self.content_shown = False
         self.initUI()
 
     # noinspection PyPep8Naming
@@ -46,15 +89,22 @@ class WebEngineView(QWidget):
 
         # setting the minimum size
         self.setMinimumSize(width, height)
-        self.webEngineView = QWebEngineView()
+        self.active = DisplayPage()
+        self.standby = DisplayPage()
+        self.stack = QStackedWidget()
+        self.stack.addWidget(self.active.view)
+        self.stack.addWidget(self.standby.view)
+        for page in (self.active, self.standby):
+            page.view.loadFinished.connect(self.log_boot_to_content)
         html = default_templates_env.get_template("loading.html").render()
-        self.webEngineView.setHtml(html, baseUrl=QUrl(f"file://{settings['default_images_folder']}"))
-        vbox.addWidget(self.webEngineView)
+        self.active.load(html, None, settings['default_images_folder'])
+        vbox.addWidget(self.stack)
         self.setLayout(vbox)
 
         self.thread = DisplayHandler()
         self.thread.default_template.connect(self.show_default_page)
         self.thread.user_template.connect(self.show_user_display)
+        self.thread.prerender_template.connect(self.prerender_user_display)
         self.thread.start()
 
         self.showFullScreen()
@@ -62,14 +112,68 @@ class WebEngineView(QWidget):
         self.show()
 
     def show_default_page(self, html):
-        self.webEngineView.setHtml(html, baseUrl=QUrl(f"file://{settings['default_images_folder']}"))
-
-    def show_user_display(self, html):
-        self.webEngineView.setHtml(html, baseUrl=QUrl(f"file://{settings['images_folder']}"))
+        self.active.load(html, None, settings['default_images_folder'])
+
+    def log_boot_to_content(self, ok):
+        """ Log how long it took to get from power on to the first user page, once it has loaded """
+        if not ok or self.content_shown or self.active.key is None:
+            return
+        self.content_shown = True
+        logger.info(f"Boot to content: {seconds_since_boot():.1f}s since boot, "
+                    f"{timer() - viewer_started:.1f}s since the viewer started")
+
+    def show_user_display(self, html, page_key="", reload=False):
+        active, standby = self.active, self.standby
+        if html == active.html and page_key == active.key and not reload:
+            return
+        if html == standby.html and page_key and page_key == standby.key and standby.loaded and not reload:
+            self.swap_pages()
+        elif settings['dom_patching'] and page_key and page_key == active.key and active.loaded and not reload:
+            self.patch_user_display(html, page_key)
+        else:
+            active.load(html, page_key, settings['images_folder'])
+
+    def prerender_user_display(self, html, page_key):
+        """ Load the next slot off-screen, ready to be swapped in when it starts """
+        start = timer()
+        self.standby.load(html, page_key, settings['images_folder'])
+        standby = self.standby
+
+        def loaded(ok):
+            standby.view.loadFinished.disconnect(loaded)
+            logger.debug(f"Pre-rendered next slot in {(timer() - start) * 1000:.0f}ms (ok={ok})")
+
+        standby.view.loadFinished.connect(loaded)
+
+    def swap_pages(self):
+        """ Show the pre-rendered page. It's already loaded, so it appears straight away """
+        self.active, self.standby = self.standby, self.active
+        self.stack.setCurrentWidget(self.active.view)
+        self.standby.clear()
+        logger.debug("Swapped in pre-rendered page")
+
+    def patch_user_display(self, html, page_key):
+        page = self.active
+        old_html = page.html
+        page.html = html
+        start = timer()
+
+        def patched(ok):
+            if ok is True:
+                PAGE_PATCH_SECONDS.observe(timer() - start)
+                logger.debug(f"Patched page in {(timer() - start) * 1000:.1f}ms")
+            elif page is self.active and page.key == page_key and page.html == html:
+                # Nothing else has been shown since, so fall back to a full reload
+                logger.debug("Could not patch page, reloading")
+                PAGE_PATCH_FALLBACKS.inc()
+                page.load(html, page_key, settings['images_folder'])
+
+        page.view.page().runJavaScript(patch_script(old_html, html), patched)
 
 
 if __name__ == "__main__":
     logger.debug("Starting viewer")
     print("Starting viewer")
+    metrics.start_exporter("viewer")
     window = WebEngineView()
     sys.exit(app.exec())
@@ -2,115 +2,244 @@ import asyncio
 import json
 import logging.config
 import socket
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from time import sleep
 
 import websockets
+from redis import asyncio as aioredis
 from websockets.exceptions import WebSocketException
 
-from lib import sync
+from lib import metrics, sync
 from lib.authentication import get_access_token
 from lib.db_helper import create_or_update_schedule_slot, create_or_update_event
+from lib.jobs import JobRunner, trigger_job
 from lib.models import Session
-from lib.utils import connect_to_redis, wait_for_internet_ping
+from lib.state_bus import publish_state, STARTUP_SYNC_COMPLETED
+from lib.utils import connect_to_redis, wait_for_internet_ping, wake_display, DISPLAY_WAKEUP_CHANNEL
 from settings import settings
 
 
-from lib.models import Base, engine
-Base.metadata.create_all(engine)
+from lib.models import init_db
+init_db()
 
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=True)
 logger = logging.getLogger("websocket")
 
+MESSAGE_WORKERS = 4  # Messages are handled in threads, as they download files and write to the database
+MAX_PENDING_MESSAGES = 256  # Stop reading from the socket if this many messages are waiting to be handled
+COALESCE_WINDOW = 0.25  # secs to collect a burst of schedule updates before applying them together
+MAX_COALESCED_UPDATES = 500  # Beyond this many updates in one window, a full sync is cheaper
+SCHEDULE_MESSAGE_TYPES = ("schedule_slot", "event")
+
+WEBSOCKET_CONNECTS = metrics.counter("kenban_websocket_connects_total", "Websocket connections opened")
+WEBSOCKET_DISCONNECTS = metrics.counter("kenban_websocket_disconnects_total",
+                                        "Websocket connections lost or that failed to open")
+WEBSOCKET_MESSAGES = metrics.counter("kenban_websocket_messages_total", "Messages received from the server")
+
 
 r = connect_to_redis()
+# For use inside the event loop, so redis calls never block the socket
+ar = aioredis.Redis(host='localhost')
+
+
+class MessageDispatcher(object):
+    """ Runs message handlers in a thread pool so the event loop is never blocked. Messages about the same entity are
+    handled one after another, in the order they arrived. Messages about different entities run concurrently """
+
+    def __init__(self, handler, workers=MESSAGE_WORKERS, max_pending=MAX_PENDING_MESSAGES):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="message")
+        self.pending = asyncio.Semaphore(max_pending)
+        self.latest = {}  # key -> task for the most recent message about that entity
+
+    async def submit(self, key, payload):
+        await self.pending.acquire()
+        previous = self.latest.get(key)
+        task = asyncio.create_task(self.run(key, previous, payload))
+        self.latest[key] = task
+
+    async def run(self, key, previous, payload):
+        try:
+            if previous:
+                await asyncio.gather(previous, return_exceptions=True)
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.handler, payload)
+        except Exception:
+            logger.exception(f"Error handling websocket message: {payload}")
+        finally:
+            self.pending.release()
+            if self.latest.get(key) is asyncio.current_task():
+                del self.latest[key]
+
+
+class UpdateCoalescer(object):
+    """ Collects the schedule slot and event updates that arrive within a short window (e.g. when a user bulk-edits a
+    schedule) and applies the latest version of each in one transaction, so the burst costs one commit and one display
+    refresh rather than one per message. If too many arrive, they're dropped in favour of a single full sync """
+
+    def __init__(self, executor, window=COALESCE_WINDOW, max_pending=MAX_COALESCED_UPDATES):
+        self.executor = executor
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = {}  # key -> latest payload
+        self.overflowed = False
+        self.flush_task = None
+        self.apply_lock = asyncio.Lock()  # Batches are applied one at a time, in order
+
+    def submit(self, key, payload):
+        if key not in self.pending and len(self.pending) >= self.max_pending:
+            if not self.overflowed:
+                logger.warning(f"More than {self.max_pending} schedule updates queued, falling back to a full sync")
+            self.overflowed = True
+            self.pending.clear()
+        if not self.overflowed:
+            self.pending.pop(key, None)  # Keep arrival order of the latest writes
+            self.pending[key] = payload
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_after_window())
+
+    async def flush_after_window(self):
+        await asyncio.sleep(self.window)
+        batch, overflowed = list(self.pending.values()), self.overflowed
+        self.pending, self.overflowed, self.flush_task = {}, False, None
+        loop = asyncio.get_running_loop()
+        async with self.apply_lock:
+            try:
+                if overflowed:
+                    # Through the job runner, so it can't overlap a scheduled or triggered full sync
+                    await loop.run_in_executor(None, trigger_job, "full_sync")
+                else:
+                    logger.debug(f"Applying {len(batch)} coalesced schedule updates")
+                    await loop.run_in_executor(self.executor, apply_schedule_updates, batch)
+            except Exception:
+                logger.exception("Error applying schedule updates")
+
+
+def message_key(payload):
+    """ Identifies the entity a message is about, for ordering """
+    message_type = payload.get("message_type")
+    return message_type, payload.get("uuid") or payload.get("image_uuid")
+
+
+async def set_websocket_flag(connected: bool):
+    """ Set websocket-connected, waking the display whenever it actually changes so the banner catches up straight
+    away, rather than at the display loop's next scheduled check """
+    previous = await ar.setbit("websocket-connected", offset=0, value=int(connected))
+    if previous != int(connected):
+        await ar.publish(DISPLAY_WAKEUP_CHANNEL, "websocket connected" if connected else "websocket disconnected")
+
+
+async def set_websocket_connected():
+    if await ar.delete("websocket-dc-timestamp"):
+        logger.info("Websocket reconnected")
+    await set_websocket_flag(True)
 
 
 async def subscribe_to_updates():
     """ Open a websocket connection with the server """
+    dispatcher = MessageDispatcher(message_handler)
+    coalescer = UpdateCoalescer(dispatcher.executor)
     while True:
         url = settings["websocket_updates_address"] + settings["device_uuid"]
         logger.info(f"Websocket attempting to connect to {url}")
         try:
             async with websockets.connect(url) as ws:
+                WEBSOCKET_CONNECTS.inc()
                 await authenticate_websocket(ws)
-                await websocket_loop(ws)
+                await websocket_loop(ws, dispatcher, coalescer)
         except (socket.gaierror, ConnectionRefusedError, OSError, WebSocketException) as e:
+            WEBSOCKET_DISCONNECTS.inc()
             # Log error and wait before trying to reconnect
-            r = connect_to_redis()
-            r.setbit("websocket-connected", offset=0, value=0)
-            if not r.exists("websocket-dc-timestamp"):
+            await set_websocket_flag(False)
+            if not await ar.exists("websocket-dc-timestamp"):
                 last_ws_connection = datetime.now()
-                r.set("websocket-dc-timestamp", last_ws_connection.timestamp())
+                await ar.set("websocket-dc-timestamp", last_ws_connection.timestamp())
                 logger.error("Websocket disconnected")
+                await ar.publish(DISPLAY_WAKEUP_CHANNEL, "websocket disconnected")
             logger.exception(e)
             await asyncio.sleep(9)
             continue
 
 
-async def websocket_loop(ws):
+async def websocket_loop(ws, dispatcher: MessageDispatcher, coalescer: UpdateCoalescer):
     logger.info("Keeping websocket open")
-    while True:
-        try:
-            r.setbit("websocket-connected", offset=0, value=1)
-            if r.exists("websocket-dc-timestamp"):
-                logger.info("Websocket reconnected")
-                r.delete("websocket-dc-timestamp")
-            msg = await asyncio.wait_for(ws.recv(), timeout=None)
-            message_handler(msg)
-        except Exception:
-            r.setbit("websocket-connected", offset=0, value=0)
-            logger.exception("Websocket error")
-            await asyncio.sleep(9)
-            return  # Close this loop
+    try:
+        await set_websocket_connected()
+        while True:
+            msg = await ws.recv()
+            WEBSOCKET_MESSAGES.inc()
+            logger.debug(f"Received websocket message: {msg}")
+            try:
+                payload = json.loads(msg)
+            except ValueError:
+                logger.error(f"Ignoring websocket message that isn't valid JSON: {msg}")
+                continue
+            if payload.get("message_type") in SCHEDULE_MESSAGE_TYPES:
+                coalescer.submit(message_key(payload), payload)
+            else:
+                await dispatcher.submit(message_key(payload), payload)
+    except Exception:
+        WEBSOCKET_DISCONNECTS.inc()
+        await set_websocket_flag(False)
+        logger.exception("Websocket error")
+        await asyncio.sleep(9)
+        return  # Close this loop
 
 
 async def authenticate_websocket(ws):
     # Send the access token to authenticate
     logger.info("Attempting to authenticate websocket")
     try:
-        access_token = get_access_token()
+        # May need to refresh the token over http, so keep it off the event loop
+        access_token = await asyncio.get_running_loop().run_in_executor(None, get_access_token)
         await ws.send(access_token)
         auth_response = await asyncio.wait_for(ws.recv(), timeout=10)
         logger.info(f"Authentication response: {auth_response}")
         if auth_response != "success":
-            r.setbit("websocket-connected", offset=0, value=0)
+            await set_websocket_flag(False)
             logger.error("Failed to authenticate websocket")
     except (asyncio.TimeoutError, websockets.ConnectionClosed):
-        r.setbit("websocket-connected", offset=0, value=0)
+        await set_websocket_flag(False)
         logger.exception("Error authenticating websocket")
     logger.info("Websocket authenticated")
 
 
-def message_handler(msg):
-    logger.debug(f"Received websocket message: {msg}")
-    payload = json.loads(msg)
+def message_handler(payload):
+    """ Apply one message from the server. Blocking, so runs in the dispatcher's thread pool """
     message_type = payload["message_type"]
     if not message_type:
         return
-    if message_type == "schedule_slot":
-        with Session() as session:
-            sync.ensure_images_and_templates_in_local_storage(payload)
-            create_or_update_schedule_slot(session, payload)
-            session.commit()
-    if message_type == "event":
-        with Session() as session:
-            sync.ensure_images_and_templates_in_local_storage(payload)
-            create_or_update_event(session, payload)
-            session.commit()
+    if message_type in SCHEDULE_MESSAGE_TYPES:
+        apply_schedule_updates([payload])
     if message_type == "image":
         image_uuid = payload["image_uuid"]
         sync.get_image(image_uuid)
         # An image change needs a force refresh because the url doesn't change (which causes a refresh)
         r.set("refresh-browser", 1)
+        wake_display("image updated")
 
 
-def wait_for_refresh_token(wt=5) -> bool:
+def apply_schedule_updates(payloads):
+    """ Save schedule slot and event messages in a single transaction. Committing publishes the changes to the
+    scheduler and wakes the display once for the whole batch """
+    for payload in payloads:
+        sync.ensure_images_and_templates_in_local_storage(payload)
+    with Session() as session:
+        for payload in payloads:
+            if payload["message_type"] == "schedule_slot":
+                create_or_update_schedule_slot(session, payload)
+            else:
+                create_or_update_event(session, payload)
+        session.commit()
+
+
+def wait_for_refresh_token(wt=60) -> bool:
+    settings.load()
     while True:
-        settings.load()
         if settings["refresh_token"] in [None, "None", ""]:
             logger.debug("Websocket waiting to start: No refresh token")
-            sleep(wt)
+            # Woken as soon as the viewer saves the token after pairing. wt is just a safety net
+            settings.wait_for_change(wt)
             continue
         else:
             return True
@@ -119,6 +248,7 @@ def wait_for_refresh_token(wt=5) -> bool:
 
 if __name__ == "__main__":
     settings.load()
+    metrics.start_exporter("websocket")
     # Don't try and connect if we don't have a token yet
     wait_for_refresh_token()
     # Wait for an internet connection
@@ -129,6 +259,8 @@ if __name__ == "__main__":
         # Allow the server to set up the new user before performing a sync
         sleep(5)
 
-    sync.full_sync()
-    r.set("startup-sync-completed", 1, 60)
+    sync.startup_sync()
+    publish_state(STARTUP_SYNC_COMPLETED, 1, ex=60)
+    # Periodic syncs, and full syncs requested with lib.jobs.trigger_job("full_sync")
+    JobRunner(sync.scheduled_jobs()).start()
     asyncio.run(subscribe_to_updates())